@@ -0,0 +1,119 @@
+"""
+Benchmark for FaceAnalyzer's detection downscaling.
+
+Runs every image in a directory at full resolution and at each requested
+DETECTION_MAX_SIDE, then reports mean latency and the fraction of
+full-resolution faces that are still found (recall, matched by IoU).
+
+Usage:
+    python benchmark_downscale.py <image_dir> [--sides 640 800 1024 1600]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "src"))
+# pylint: disable=import-error, wrong-import-position
+from face_analyzer import FaceAnalyzer
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def face_boxes(results):
+    """Return the (x, y, w, h) regions from DeepFace results."""
+    if not results:
+        return []
+    faces = results if isinstance(results, list) else [results]
+    boxes = []
+    for face in faces:
+        region = face.get("region") or {}
+        boxes.append((region["x"], region["y"], region["w"], region["h"]))
+    return boxes
+
+
+def iou(box_a, box_b):
+    """Return the intersection-over-union of two (x, y, w, h) boxes."""
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    inter_w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    inter_h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    intersection = inter_w * inter_h
+    union = aw * ah + bw * bh - intersection
+    return intersection / union if union else 0.0
+
+
+def matched_faces(reference, candidates, threshold):
+    """Count reference boxes that have a candidate box with IoU >= threshold."""
+    remaining = list(candidates)
+    matched = 0
+    for ref in reference:
+        best = max(remaining, key=lambda box, ref=ref: iou(ref, box), default=None)
+        if best is not None and iou(ref, best) >= threshold:
+            remaining.remove(best)
+            matched += 1
+    return matched
+
+
+def timed_boxes(analyzer, path):
+    """Analyze one image and return (seconds, boxes)."""
+    start = time.perf_counter()
+    results = analyzer.analyze(path)
+    return time.perf_counter() - start, face_boxes(results)
+
+
+def run_configuration(analyzer, paths, reference, threshold):
+    """Analyze all images; return (total seconds, faces matching the reference)."""
+    elapsed, found = 0.0, 0
+    for path in paths:
+        seconds, boxes = timed_boxes(analyzer, path)
+        elapsed += seconds
+        if reference is not None:
+            found += matched_faces(reference[path], boxes, threshold)
+        else:
+            found += len(boxes)
+    return elapsed, found
+
+
+def main():
+    """Run the benchmark and print a latency/recall table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("image_dir")
+    parser.add_argument("--sides", type=int, nargs="+", default=[640, 800, 1024, 1600])
+    parser.add_argument("--iou", type=float, default=0.5)
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.image_dir, name)
+        for name in os.listdir(args.image_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        parser.error(f"No images found in {args.image_dir}")
+
+    full = FaceAnalyzer(detection_max_side=0)
+    # Warm up model loading so it is not attributed to the first configuration.
+    full.analyze(paths[0])
+
+    reference = {path: face_boxes(full.analyze(path)) for path in paths}
+    reference_time, total_faces = run_configuration(full, paths, None, args.iou)
+
+    print(f"{len(paths)} images, {total_faces} faces at full resolution")
+    print(f"{'max_side':>10} {'mean_ms':>10} {'speedup':>8} {'recall':>8}")
+    print(
+        f"{'full':>10} {reference_time / len(paths) * 1000:>10.1f} {1.0:>8.2f} {1.0:>8.2f}"
+    )
+    for side in args.sides:
+        analyzer = FaceAnalyzer(detection_max_side=side)
+        elapsed, found = run_configuration(analyzer, paths, reference, args.iou)
+        recall = found / total_faces if total_faces else 1.0
+        speedup = reference_time / elapsed if elapsed else 0.0
+        print(
+            f"{side:>10} {elapsed / len(paths) * 1000:>10.1f} "
+            f"{speedup:>8.2f} {recall:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,11 @@ class DummyDeepFace:
         """Dummy analyze method that accepts any keyword arguments and returns a fixed result."""
         return {"emotion": {"happy": 1.0}}
 
+    @staticmethod
+    def extract_faces(**kwargs):  # pylint: disable=unused-argument
+        """Dummy extract_faces method that returns one face covering a fixed area."""
+        return [{"facial_area": {"x": 0, "y": 0, "w": 10, "h": 10}, "confidence": 1.0}]
+
 
 dummy_deepface.DeepFace = DummyDeepFace
 
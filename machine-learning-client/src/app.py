@@ -11,17 +11,45 @@ from pymongo import MongoClient
 from flask import Flask, request, jsonify, redirect, send_file, flash
 from face_analyzer import FaceAnalyzer
 from db_handler import DBHandler
+from retention import RetentionSweeper
+import profiler
+import cache
+import capture
+import compact_results
 from config import Config
 
 app = Flask(__name__)
 app.config.from_object(Config)
 app.secret_key = Config.SECRET_KEY or "test_secret"
 app.config["TESTING"] = True
+profiler.install(app)
+capture.install(app)
 
 analyzer = FaceAnalyzer()
 database = DBHandler()
 images_collection = MongoClient(Config.MONGO_URI)[Config.MONGO_DBNAME]["images"]
 app.images_collection = images_collection
+# Analyses and their images never change once written, so lookups can be cached.
+document_cache = cache.ReadThroughCache()
+
+sweeper = RetentionSweeper(
+    database.database,
+    on_image_removed=lambda analysis_id: document_cache.invalidate(
+        ("image", analysis_id)
+    ),
+)
+sweeper.ensure_ttl_index()
+sweeper.start()
+
+
+def image_expiry(doc):
+    """Returns when a stored image expires along with its analysis, or None."""
+    return cache.document_expiry(doc, "upload_date", Config.ANALYSIS_TTL_DAYS)
+
+
+def analysis_expiry(analysis):
+    """Returns when an analysis expires under ANALYSIS_TTL_DAYS, or None."""
+    return cache.document_expiry(analysis, "timestamp", Config.ANALYSIS_TTL_DAYS)
 
 
 def error_response(message, status_code):
@@ -29,6 +57,60 @@ def error_response(message, status_code):
     return jsonify({"error": message}), status_code
 
 
+def analysis_settings(data):
+    """
+    Resolves the DeepFace settings for a JSON request from its optional
+    "profile" name and "actions" list, which overrides the profile's actions.
+    Returns (profile name, settings); raises ValueError for invalid choices.
+    """
+    profile = data.get("profile") or Config.DEFAULT_PROFILE
+    settings = Config.get_profile(profile) if isinstance(profile, str) else None
+    if settings is None:
+        raise ValueError(f"Unknown profile: {profile}")
+    settings = dict(settings)
+    actions = data.get("actions")
+    if actions is not None:
+        if (
+            not isinstance(actions, list)
+            or not actions
+            or not all(action in Config.SUPPORTED_ACTIONS for action in actions)
+        ):
+            raise ValueError(
+                f"actions must be a non-empty list of {list(Config.SUPPORTED_ACTIONS)}"
+            )
+        settings["actions"] = actions
+    return profile, settings
+
+
+def save_data_url(image_data):
+    """
+    Decodes a base64 JPEG or PNG data URL into a new file in Config.TEMP_DIR.
+    Returns the file's path; raises ValueError for other image types.
+    """
+    header, base64_str = image_data.split(",", 1)
+    if "jpeg" in header:
+        ext = ".jpg"
+    elif "png" in header:
+        ext = ".png"
+    else:
+        raise ValueError("Unsupported image type")
+    temp_path = os.path.join(Config.TEMP_DIR, f"{uuid.uuid4()}{ext}")
+    with open(temp_path, "wb") as f:
+        f.write(base64.b64decode(base64_str))
+    return temp_path
+
+
+def analyze_temp_file(temp_path, **settings):
+    """
+    Analyzes an image saved by the request and deletes the file afterwards;
+    nothing reads it again once the results are known.
+    """
+    try:
+        return analyzer.analyze(temp_path, **settings)
+    finally:
+        os.remove(temp_path)
+
+
 @app.route("/", methods=["POST"])
 def analyze():
     """
@@ -42,27 +124,23 @@ def analyze():
             return error_response("No file provided", 400)
 
         try:
-            image_data = data["image"]
-            header, base64_str = image_data.split(",", 1)
-            if "jpeg" in header:
-                ext = ".jpg"
-            elif "png" in header:
-                ext = ".png"
-            else:
-                raise ValueError("Unsupported image type")
-            temp_path = f"/tmp/{uuid.uuid4()}{ext}"
-            with open(temp_path, "wb") as f:
-                f.write(base64.b64decode(base64_str))
-            results = analyzer.analyze(temp_path)
+            profile, settings = analysis_settings(data)
+            temp_path = save_data_url(data["image"])
+            results = analyze_temp_file(temp_path, **settings)
             if not results:
-                os.remove(temp_path)
                 raise ValueError("No faces detected")
-            analysis_id = database.store_analysis(temp_path, results)
+            compact = compact_results.compact(results)
+            analysis_id = database.store_analysis(
+                temp_path, compact, models=settings["actions"], profile=profile
+            )
+            # Callers opt in to the compact wire format; others get DeepFace's.
+            wants_compact = data.get("format") == "compact"
             response = jsonify(
                 {
                     "analysis_id": analysis_id,
-                    "results": results,
-                    "models": Config.DEEPFACE_MODELS,
+                    "results": compact if wants_compact else results,
+                    "models": settings["actions"],
+                    "profile": profile,
                 }
             )
             return response, 200
@@ -76,47 +154,82 @@ def analyze():
         return redirect(request.url)
 
     ext = os.path.splitext(file.filename)[1] or ".jpg"
-    temp_path = f"/tmp/{uuid.uuid4()}{ext}"
+    temp_path = os.path.join(Config.TEMP_DIR, f"{uuid.uuid4()}{ext}")
     file.save(temp_path)
 
-    results = analyzer.analyze(temp_path)
+    results = analyze_temp_file(temp_path)
     if not results:
-        os.remove(temp_path)
         flash("No faces detected")
         return redirect(request.url)
 
-    analysis_id = database.store_analysis(temp_path, results)
+    analysis_id = database.store_analysis(temp_path, compact_results.compact(results))
     return redirect(f"/uploads/{analysis_id}")
 
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """
+    Readiness endpoint used by the web app's load balancer health checks.
+    Returns 200 when the analyzer is configured, 503 otherwise.
+    """
+    if not analyzer.validate_config():
+        return jsonify({"status": "unavailable"}), 503
+    return jsonify({"status": "ready"}), 200
+
+
 @app.route("/uploads/<analysis_id>", methods=["GET"])
 def get_image(analysis_id):
     """
     Retrieves and sends the image file corresponding to the given analysis_id.
     If the image is not found, flashes an error and redirects to the root URL.
     """
-    doc = app.images_collection.find_one({"analysis_id": analysis_id})
+    doc = document_cache.get_or_load(
+        ("image", analysis_id),
+        lambda: app.images_collection.find_one({"analysis_id": analysis_id}),
+        image_expiry,
+    )
     if not doc:
         flash("Image not found")
         return redirect(request.url_root)
-    return send_file(
+    etag = f"image-{analysis_id}"
+    if request.if_none_match.contains_weak(etag):
+        return cache.not_modified(etag, image_expiry(doc))
+    response = send_file(
         io.BytesIO(doc["data"]),
         mimetype=doc["content_type"],
         as_attachment=True,
         download_name=doc["filename"],
     )
+    cache.immutable_headers(response, etag, doc.get("upload_date"), image_expiry(doc))
+    return response.make_conditional(request)
 
 
 @app.route("/analysis/<analysis_id>", methods=["GET"])
 def get_analysis(analysis_id):
     """
     Endpoint to retrieve analysis results by analysis ID.
-    Returns the analysis data or an error message.
+    Returns the analysis data (results in the compact form with ?format=compact)
+    or an error message.
     """
-    analysis = database.get_analysis(analysis_id)
+    analysis = document_cache.get_or_load(
+        ("analysis", analysis_id),
+        lambda: database.get_analysis(analysis_id),
+        analysis_expiry,
+    )
     if not analysis:
         return jsonify({"error": "Analysis not found"}), 404
-    return jsonify(analysis)
+    etag = f"analysis-{analysis_id}"
+    if request.if_none_match.contains_weak(etag):
+        return cache.not_modified(etag, analysis_expiry(analysis))
+    if request.args.get("format") != "compact":
+        analysis = dict(
+            analysis, results=compact_results.expand(analysis.get("results"))
+        )
+    response = jsonify(analysis)
+    cache.immutable_headers(
+        response, etag, analysis.get("timestamp"), analysis_expiry(analysis)
+    )
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,298 @@
+"""
+Read-through cache for write-once MongoDB documents (stored images and analyses).
+Entries live in a memory-bounded in-process LRU and, when CACHE_DIR is set, in a
+local directory of BSON files shared by every worker process on the host.
+Documents can still expire through retention TTLs or be re-encoded by compaction,
+so no entry outlives its document's expiry or CACHE_TTL_SECONDS.
+"""
+
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import bson
+from bson.errors import BSONError
+from werkzeug.wrappers import Response
+
+from config import Config
+
+CACHE_MAX_BYTES = Config.CACHE_MAX_BYTES
+CACHE_DIR = Config.CACHE_DIR
+CACHE_DIR_MAX_BYTES = Config.CACHE_DIR_MAX_BYTES
+CACHE_TTL_SECONDS = Config.CACHE_TTL_SECONDS
+
+# Everything below is identical in both services' copies of this module.
+
+# Responses for cached resources may be stored by browsers for up to a year.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def document_expiry(document, field, days):
+    """
+    Returns when a document expires through a TTL of `days` on its `field`,
+    or None when the policy is disabled or the field is missing.
+    """
+    created = (document or {}).get(field)
+    if days <= 0 or not isinstance(created, datetime):
+        return None
+    return created + timedelta(days=days)
+
+
+def seconds_until(moment):
+    """Returns the seconds from now until a datetime (naive values are UTC)."""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return (moment - datetime.now(timezone.utc)).total_seconds()
+
+
+def approximate_size(value):
+    """Estimates the memory held by a document built from dicts, lists, str and bytes."""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value) + 64
+    if isinstance(value, dict):
+        return 64 + sum(
+            approximate_size(k) + approximate_size(v) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(approximate_size(item) for item in value)
+    return 32
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache that evicts entries once max_bytes is exceeded.
+    Entries may carry an expiry time (time.time() seconds) after which they are dropped.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at is not None and time.time() >= expires_at:
+                del self._entries[key]
+                self.current_bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        """Stores value under key, evicting least recently used entries as needed."""
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, size, expires_at)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def delete(self, key):
+        """Removes the entry for key, if any."""
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.current_bytes -= previous[1]
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+class DiskCache:
+    """
+    A BSON-file-per-entry cache in a local directory, pruned oldest-first by size.
+    BSON is used rather than pickle because other processes can write to the
+    directory, and decoding BSON never executes code.
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_DIR_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.bson")
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = bson.decode(f.read())
+        except (OSError, BSONError):
+            return None
+        expires_at = entry.get("expires_at")
+        if expires_at is not None and time.time() >= expires_at:
+            self._remove(path)
+            return None
+        return entry.get("value")
+
+    def set(self, key, value, expires_at=None):
+        """Atomically writes value under key."""
+        try:
+            data = bson.encode({"expires_at": expires_at, "value": value})
+        except (BSONError, TypeError):
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def delete(self, key):
+        """Removes the entry for key, if any."""
+        self._remove(self._path(key))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Deletes the oldest entries until the directory fits in max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".bson"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class ReadThroughCache:
+    """Looks documents up in memory, then on disk, then via the supplied loader."""
+
+    def __init__(
+        self, max_bytes=CACHE_MAX_BYTES, directory=CACHE_DIR, ttl=CACHE_TTL_SECONDS
+    ):
+        self.memory = LRUCache(max_bytes)
+        self.disk = DiskCache(directory) if directory else None
+        self.ttl = ttl
+
+    def _expires_at(self, value, expiry):
+        """Returns the time.time() at which a freshly loaded value must be dropped."""
+        lifetime = self.ttl if self.ttl > 0 else None
+        deadline = expiry(value) if expiry is not None else None
+        if deadline is not None:
+            remaining = seconds_until(deadline)
+            lifetime = remaining if lifetime is None else min(lifetime, remaining)
+        return None if lifetime is None else time.time() + lifetime
+
+    def _cached(self, key, expiry):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value, self._expires_at(value, expiry))
+        return value
+
+    def _store(self, key, value, expiry):
+        expires_at = self._expires_at(value, expiry)
+        if expires_at is None or expires_at > time.time():
+            self.memory.set(key, value, expires_at)
+            if self.disk is not None:
+                self.disk.set(key, value, expires_at)
+
+    def get_or_load(self, key, loader, expiry=None):
+        """
+        Returns the value cached under key, calling loader() on a miss.
+        expiry(value) may return the datetime at which the document itself
+        expires; the value is never served from the cache after that.
+        None results are not cached so missing documents are looked up again.
+        """
+        value = self._cached(key, expiry)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self._store(key, value, expiry)
+        return value
+
+    async def get_or_load_async(self, key, loader, expiry=None):
+        """
+        Async counterpart of get_or_load(): loader() returns an awaitable, and
+        the disk tier is read and written on a worker thread.
+        """
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = await asyncio.to_thread(self._cached, key, expiry)
+        if value is None:
+            value = await loader()
+            if value is not None:
+                await asyncio.to_thread(self._store, key, value, expiry)
+        return value
+
+    def invalidate(self, key):
+        """Drops key from every tier, e.g. after its document was rewritten."""
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def clear(self):
+        """Empties the in-process tier."""
+        self.memory.clear()
+
+
+def immutable_headers(response, etag, last_modified=None, expires_at=None):
+    """
+    Marks a response for a write-once resource as cacheable until expires_at
+    (the document's retention expiry), or for a year when it never expires.
+    Callers then use response.make_conditional(request) to answer revalidations.
+    """
+    # Weak because retention may later re-encode the stored bytes of the same image.
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    max_age = IMMUTABLE_MAX_AGE
+    if expires_at is not None:
+        max_age = max(0, min(max_age, int(seconds_until(expires_at))))
+    # send_file() defaults to no-cache, which would override immutable.
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response
+
+
+def not_modified(etag, expires_at=None):
+    """
+    Builds the 304 response sent when a client already holds the resource,
+    cacheable no longer than the document's expires_at.
+    """
+    return immutable_headers(Response(status=304), etag, expires_at=expires_at)
@@ -0,0 +1,151 @@
+"""
+Traffic capture middleware for the machine learning client.
+Records a sample of incoming requests as JSON lines (one request per line, keyed
+by request_id) that tools/replay.py can reissue. Image payloads are never written
+inline: they are replaced by their SHA-256 and size, and the bytes are stored by
+reference in CAPTURE_BLOB_DIR when that is set.
+Nothing is installed unless CAPTURE_SAMPLE_RATE is above 0.
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, request
+from config import Config
+
+CAPTURE_SAMPLE_RATE = Config.CAPTURE_SAMPLE_RATE
+CAPTURE_PATH = Config.CAPTURE_PATH
+CAPTURE_BLOB_DIR = Config.CAPTURE_BLOB_DIR
+SERVICE_NAME = "machine-learning-client"
+
+
+def _log(message):
+    """Reports an operational message at a level the default logging setup shows."""
+    logging.warning(message)
+
+
+# Everything below is identical in both services' copies of this module.
+
+# Form and JSON fields that carry base64 data URLs rather than plain values.
+DATA_URL_FIELDS = ("image", "captured_image")
+
+_write_lock = threading.Lock()
+
+
+def blob_reference(data, content_type):
+    """
+    Describes binary data by hash and size, storing the bytes under
+    CAPTURE_BLOB_DIR/<sha256> when blob storage is enabled.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    reference = {"sha256": digest, "size": len(data), "content_type": content_type}
+    if CAPTURE_BLOB_DIR:
+        path = os.path.join(CAPTURE_BLOB_DIR, digest)
+        if not os.path.exists(path):
+            os.makedirs(CAPTURE_BLOB_DIR, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        reference["ref"] = digest
+    return reference
+
+
+def data_url_reference(value):
+    """Replaces a base64 data URL with a blob reference; other values pass through."""
+    if not isinstance(value, str) or not value.startswith("data:"):
+        return value
+    header, _, encoded = value.partition(",")
+    try:
+        data = base64.b64decode(encoded)
+    except (binascii.Error, ValueError):
+        return {"invalid_data_url": True, "size": len(value)}
+    content_type = header[len("data:") :].split(";", 1)[0]
+    return {"data_url": blob_reference(data, content_type)}
+
+
+def describe_request():
+    """Builds the capture record for the current request, minus its outcome."""
+    record = {
+        "request_id": str(uuid.uuid4()),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "service": SERVICE_NAME,
+        "method": request.method,
+        "path": request.path,
+        "query": request.query_string.decode("latin-1"),
+        "content_type": request.mimetype,
+    }
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            body = {
+                key: data_url_reference(value) if key in DATA_URL_FIELDS else value
+                for key, value in body.items()
+            }
+        record["json"] = body
+    elif request.form or request.files:
+        record["form"] = {
+            key: data_url_reference(value) if key in DATA_URL_FIELDS else value
+            for key, value in request.form.items()
+        }
+        files = {}
+        for key, file_obj in request.files.items():
+            data = file_obj.read()
+            file_obj.stream.seek(0)
+            files[key] = dict(
+                blob_reference(data, file_obj.mimetype), filename=file_obj.filename
+            )
+        record["files"] = files
+    return record
+
+
+def write_record(record):
+    """Appends one record to CAPTURE_PATH."""
+    line = json.dumps(record, default=str)
+    with _write_lock:
+        os.makedirs(os.path.dirname(CAPTURE_PATH) or ".", exist_ok=True)
+        with open(CAPTURE_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def _start_capture():
+    if random.random() < CAPTURE_SAMPLE_RATE:
+        # Sampling must never fail the request itself, e.g. on an unwritable blob dir.
+        try:
+            g.capture_record = describe_request()
+        except OSError as err:
+            _log(f"Traffic capture dropped a sample: {err}")
+            return
+        g.capture_started = time.perf_counter()
+
+
+def _finish_capture(response):
+    record = g.pop("capture_record", None)
+    if record is not None:
+        record["status"] = response.status_code
+        record["latency_ms"] = round(
+            (time.perf_counter() - g.pop("capture_started")) * 1000, 3
+        )
+        try:
+            write_record(record)
+        except OSError as err:
+            _log(f"Traffic capture failed: {err}")
+    return response
+
+
+def install(app):
+    """
+    Registers the capture hooks on app.
+    Does nothing unless CAPTURE_SAMPLE_RATE is above 0.
+    """
+    if CAPTURE_SAMPLE_RATE <= 0:
+        return
+    app.before_request(_start_capture)
+    app.after_request(_finish_capture)
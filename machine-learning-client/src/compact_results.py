@@ -0,0 +1,135 @@
+"""
+Compact, versioned representation of DeepFace analysis results.
+
+DeepFace returns one dict per face with float-valued percentage maps for every
+emotion and gender. The compact form keeps each face as a small positional array
+with probabilities quantized to 0-255 in a fixed order, which shrinks the JSON
+exchanged between services and the BSON stored in MongoDB:
+
+    {"v": 1, "faces": [[[x, y, w, h], age, [woman, man], [angry, ..., neutral]]]}
+
+Attributes that were not analyzed are null. expand() turns the compact form back
+into DeepFace's legacy list-of-dicts shape and passes legacy results through.
+
+The web app and the ML client each ship an identical copy of this module because
+their Docker build contexts are separate; web-app/test_app.py fails if they drift.
+"""
+
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+WIRE_VERSION = 1
+# The order of these labels is part of wire version 1.
+EMOTIONS = ("angry", "disgust", "fear", "happy", "sad", "surprise", "neutral")
+GENDERS = ("Woman", "Man")
+REGION_KEYS = ("x", "y", "w", "h")
+
+
+def quantize(percentages, labels):
+    """Packs a {label: percent} map into a tuple of 0-255 levels in label order."""
+    return tuple(
+        min(255, max(0, int(round(float(percentages.get(label, 0.0)) * 2.55))))
+        for label in labels
+    )
+
+
+def dequantize(levels, labels):
+    """Unpacks 0-255 levels into a {label: percent} map."""
+    return {label: round(level / 2.55, 2) for label, level in zip(labels, levels)}
+
+
+def dominant(levels, labels):
+    """Returns the label with the highest level."""
+    return labels[max(range(len(levels)), key=levels.__getitem__)]
+
+
+@dataclass
+class FaceResult:
+    """One analyzed face in compact form."""
+
+    __slots__ = ("region", "age", "gender", "emotion")
+
+    region: Tuple[int, int, int, int]
+    age: Optional[int]
+    gender: Optional[Tuple[int, ...]]
+    emotion: Optional[Tuple[int, ...]]
+
+    @classmethod
+    def from_deepface(cls, face):
+        """Builds a FaceResult from one DeepFace result dict."""
+        region = face.get("region") or {}
+        gender = face.get("gender")
+        emotion = face.get("emotion")
+        age = face.get("age")
+        return cls(
+            region=tuple(int(region.get(key, 0)) for key in REGION_KEYS),
+            age=int(round(age)) if age is not None else None,
+            gender=quantize(gender, GENDERS) if isinstance(gender, dict) else None,
+            emotion=quantize(emotion, EMOTIONS) if isinstance(emotion, dict) else None,
+        )
+
+    @classmethod
+    def from_wire(cls, values):
+        """Builds a FaceResult from its wire array."""
+        region, age, gender, emotion = values
+        return cls(
+            region=tuple(region),
+            age=age,
+            gender=tuple(gender) if gender is not None else None,
+            emotion=tuple(emotion) if emotion is not None else None,
+        )
+
+    def to_wire(self):
+        """Returns the JSON/BSON-serialisable wire array for this face."""
+        return [
+            list(self.region),
+            self.age,
+            list(self.gender) if self.gender is not None else None,
+            list(self.emotion) if self.emotion is not None else None,
+        ]
+
+    def to_legacy(self):
+        """Returns this face in DeepFace's dict shape."""
+        face = {"region": dict(zip(REGION_KEYS, self.region))}
+        if self.age is not None:
+            face["age"] = self.age
+        if self.gender is not None:
+            face["gender"] = dequantize(self.gender, GENDERS)
+            face["dominant_gender"] = dominant(self.gender, GENDERS)
+        if self.emotion is not None:
+            face["emotion"] = dequantize(self.emotion, EMOTIONS)
+            face["dominant_emotion"] = dominant(self.emotion, EMOTIONS)
+        return face
+
+
+def is_compact(results):
+    """Checks whether results are in the versioned compact form."""
+    return isinstance(results, dict) and "v" in results and "faces" in results
+
+
+def compact(results):
+    """Converts DeepFace results (a dict or list of dicts) to the compact form."""
+    if is_compact(results):
+        return results
+    faces = results if isinstance(results, list) else [results]
+    return {
+        "v": WIRE_VERSION,
+        "faces": [FaceResult.from_deepface(face).to_wire() for face in faces],
+    }
+
+
+def decode(results):
+    """Returns the FaceResults held in compact results."""
+    if results.get("v") != WIRE_VERSION:
+        raise ValueError(f"Unsupported results version: {results.get('v')}")
+    return [FaceResult.from_wire(values) for values in results["faces"]]
+
+
+def expand(results):
+    """
+    Converts compact results to DeepFace's legacy list of dicts.
+    Anything not in the compact form (legacy documents, error strings) is returned as is.
+    """
+    if not is_compact(results):
+        return results
+    return [face.to_legacy() for face in decode(results)]
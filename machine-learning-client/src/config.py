@@ -19,11 +19,47 @@ class Config:
     DEEPFACE_MODELS = os.getenv("DEEPFACE_MODELS", "age,gender,emotion").split(",")
     DETECTOR_THRESHOLD = float(os.getenv("DETECTOR_THRESHOLD", "0.9"))
     ENFORCE_DETECTION = os.getenv("ENFORCE_DETECTION", "true").lower() == "true"
+    # Longest image side used for detection; larger images are downscaled (0 disables)
+    DETECTION_MAX_SIDE = int(os.getenv("DETECTION_MAX_SIDE", "1024"))
+    # Actions a request may ask for; compact results only carry these three.
+    SUPPORTED_ACTIONS = ("age", "gender", "emotion")
+
+    # Performance profiles selectable per request; "full" uses the settings above
+    DEFAULT_PROFILE = os.getenv("DEFAULT_PROFILE", "full")
+    FAST_PROFILE_BACKEND = os.getenv("FAST_PROFILE_BACKEND", "opencv")
+    FAST_PROFILE_MODELS = os.getenv("FAST_PROFILE_MODELS", "emotion").split(",")
+    FAST_PROFILE_MAX_SIDE = int(os.getenv("FAST_PROFILE_MAX_SIDE", "640"))
 
     # MongoDB
     MONGO_URI = os.getenv("MONGO_URI")
     MONGO_DBNAME = os.getenv("MONGO_DBNAME")
 
+    # Retention (0 disables a policy)
+    TEMP_DIR = os.getenv("TEMP_DIR", "/tmp")
+    ANALYSIS_TTL_DAYS = int(os.getenv("ANALYSIS_TTL_DAYS", "0"))
+    TEMP_FILE_GRACE_SECONDS = int(os.getenv("TEMP_FILE_GRACE_SECONDS", "3600"))
+    RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "0"))
+
+    # Response caching (CACHE_DIR enables the shared on-disk tier)
+    CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    CACHE_DIR = os.getenv("CACHE_DIR", "")
+    CACHE_DIR_MAX_BYTES = int(os.getenv("CACHE_DIR_MAX_BYTES", str(512 * 1024 * 1024)))
+    # Entries are reloaded after this long so retention changes are seen (0 = never)
+    CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "3600"))
+
+    # Profiling (opt-in)
+    PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+    TRACEMALLOC_ENABLED = os.getenv("TRACEMALLOC_ENABLED", "false").lower() == "true"
+    PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+    PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+    PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+    TRACEMALLOC_SNAPSHOT_EVERY = int(os.getenv("TRACEMALLOC_SNAPSHOT_EVERY", "50"))
+
+    # Traffic capture (0 disables; see tools/replay.py)
+    CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "0"))
+    CAPTURE_PATH = os.getenv("CAPTURE_PATH", "/tmp/capture/requests.jsonl")
+    CAPTURE_BLOB_DIR = os.getenv("CAPTURE_BLOB_DIR", "")
+
     # Flask
     SECRET_KEY = os.getenv("FLASK_SECRET_KEY")
     API_KEY = os.getenv("API_KEY")
@@ -36,6 +72,26 @@ class Config:
         """
         return Config.DEBUG
 
+    @staticmethod
+    def get_profile(name):
+        """
+        Retrieve the analysis settings of a named performance profile.
+        Returns None for unknown profile names.
+        """
+        profiles = {
+            "full": {
+                "actions": Config.DEEPFACE_MODELS,
+                "detector_backend": Config.DEEPFACE_BACKEND,
+                "max_side": Config.DETECTION_MAX_SIDE,
+            },
+            "fast": {
+                "actions": Config.FAST_PROFILE_MODELS,
+                "detector_backend": Config.FAST_PROFILE_BACKEND,
+                "max_side": Config.FAST_PROFILE_MAX_SIDE,
+            },
+        }
+        return profiles.get(name)
+
     @staticmethod
     def get_mongo_uri():
         """
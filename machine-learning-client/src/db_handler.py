@@ -20,13 +20,16 @@ class DBHandler:
         self.client = MongoClient(Config.MONGO_URI)
         self.database = self.client[Config.MONGO_DBNAME]
 
-    def store_analysis(self, image_path, results):
+    def store_analysis(self, image_path, results, models=None, profile=None):
         """
         Stores analysis results in the database.
 
         Args:
             image_path (str): Path to the analyzed image.
-            results (dict): Analysis results.
+            results (dict): Analysis results, normally in compact_results form.
+            models (list): Actions that produced the results; defaults to
+                Config.DEEPFACE_MODELS.
+            profile (str): Performance profile that produced the results.
 
         Returns:
             ObjectId: The ID of the inserted document.
@@ -36,7 +39,8 @@ class DBHandler:
             "analysis_id": analysis_id,
             "image_path": image_path,
             "results": results,
-            "models": Config.DEEPFACE_MODELS,
+            "models": models or Config.DEEPFACE_MODELS,
+            "profile": profile or Config.DEFAULT_PROFILE,
             "timestamp": datetime.now(timezone.utc),
         }
         # Perform the insertion but ignore the ObjectId returned by insert_one
@@ -53,4 +57,4 @@ class DBHandler:
         Returns:
             dict: The analysis document, or None if not found.
         """
-        return self.database.analyses.find_one({"analysis_id": analysis_id})
+        return self.database.analyses.find_one({"analysis_id": analysis_id}, {"_id": 0})
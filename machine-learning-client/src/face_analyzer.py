@@ -3,8 +3,15 @@ This module provides a FaceAnalyzer class for analyzing facial attributes using
 """
 
 import logging
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
 from deepface import DeepFace
 from config import Config
+from profiler import track_memory
+
+# Largest input side of the attribute models (VGG-Face based age and gender
+# take 224x224), so face crops never need to be decoded with more detail.
+FACE_INPUT_SIDE = 224
 
 
 class FaceAnalyzer:
@@ -12,34 +19,229 @@ class FaceAnalyzer:
     A class to analyze facial attributes using DeepFace.
     """
 
-    def __init__(self):
+    def __init__(self, detection_max_side=None):
         """
         Initializes the FaceAnalyzer with configuration settings.
+
+        Args:
+            detection_max_side (int): Overrides Config.DETECTION_MAX_SIDE when given.
         """
         self.config = Config()
+        if detection_max_side is None:
+            detection_max_side = self.config.DETECTION_MAX_SIDE
+        self.detection_max_side = detection_max_side
 
-    def analyze(self, image_path):
+    @track_memory
+    def analyze(self, image_path, actions=None, detector_backend=None, max_side=None):
         """
         Analyzes the given image for facial attributes.
 
+        Large images are searched for faces on a downscaled copy; the attribute
+        models then run on crops of the original decoded at the reduced size the
+        faces allow, and face regions are reported in the original coordinates.
+
         Args:
             image_path (str): Path to the image to be analyzed.
+            actions (list): Overrides Config.DEEPFACE_MODELS when given.
+            detector_backend (str): Overrides Config.DEEPFACE_BACKEND when given.
+            max_side (int): Overrides detection_max_side when given.
 
         Returns:
             dict: Analysis results or None if an error occurs.
         """
+        actions = actions or self.config.DEEPFACE_MODELS
+        detector_backend = detector_backend or self.config.DEEPFACE_BACKEND
+        img, scale = self.load_for_detection(image_path, max_side)
         try:
-            return DeepFace.analyze(
-                img_path=image_path,
-                actions=self.config.DEEPFACE_MODELS,
-                detector_backend=self.config.DEEPFACE_BACKEND,
-                enforce_detection=self.config.ENFORCE_DETECTION,
-                silent=True,
-            )
+            if scale == 1.0:
+                return DeepFace.analyze(
+                    img_path=img,
+                    actions=actions,
+                    detector_backend=detector_backend,
+                    enforce_detection=self.config.ENFORCE_DETECTION,
+                    silent=True,
+                )
+            return self.analyze_crops(image_path, img, scale, actions, detector_backend)
         except ValueError as e:
             logging.error("Analysis failed: %s", str(e))
             return None
 
+    def analyze_crops(self, image_path, img, scale, actions, detector_backend):
+        """
+        Detects faces on a downscaled image and analyzes crops of the original.
+
+        The original is decoded only as large as the smallest detected face
+        needs to stay at least FACE_INPUT_SIDE pixels, so JPEGs use the
+        decoder's reduced scales; formats without them are decoded at full size.
+        The age, gender and emotion models skip detection on each crop.
+
+        Args:
+            image_path (str): Path to the full-resolution image.
+            img (numpy.ndarray): Downscaled BGR image used for detection.
+            scale (float): Ratio of original to downscaled image size.
+            actions (list): DeepFace actions to run.
+            detector_backend (str): DeepFace detector used on the downscaled image.
+
+        Returns:
+            list: One DeepFace result dict per face, in original coordinates.
+        """
+        faces = DeepFace.extract_faces(
+            img_path=img,
+            detector_backend=detector_backend,
+            enforce_detection=self.config.ENFORCE_DETECTION,
+            align=False,
+        )
+        if not faces:
+            return []
+        regions = self.scale_regions(
+            [{"region": dict(face["facial_area"])} for face in faces], scale
+        )
+
+        smallest = min(min(r["region"]["w"], r["region"]["h"]) for r in regions)
+        decoded, factor = self.load_reduced(
+            image_path, max(1.0, smallest / FACE_INPUT_SIDE)
+        )
+
+        results = []
+        for face, entry in zip(faces, regions):
+            result = self.analyze_region(decoded, entry["region"], factor, actions)
+            result["face_confidence"] = face.get("confidence")
+            results.append(result)
+        return results
+
+    def analyze_region(self, decoded, region, factor, actions):
+        """
+        Runs the attribute models on one face of a reduced-size decode.
+
+        Args:
+            decoded (PIL.Image.Image): The image from load_reduced().
+            region (dict): Face region in original image coordinates.
+            factor (float): Ratio of original to decoded size.
+            actions (list): DeepFace actions to run.
+
+        Returns:
+            dict: The DeepFace result, with region in original coordinates.
+        """
+        box = (
+            max(0, int(region["x"] / factor)),
+            max(0, int(region["y"] / factor)),
+            min(decoded.width, int((region["x"] + region["w"]) / factor)),
+            min(decoded.height, int((region["y"] + region["h"]) / factor)),
+        )
+        analysis = DeepFace.analyze(
+            img_path=self.to_bgr(decoded.crop(box).convert("RGB")),
+            actions=actions,
+            detector_backend="skip",
+            enforce_detection=False,
+            silent=True,
+        )
+        result = analysis[0] if isinstance(analysis, list) else analysis
+        result["region"] = region
+        return result
+
+    @staticmethod
+    def load_reduced(image_path, reduction):
+        """
+        Decodes an image at up to `reduction` times smaller than its original
+        size, using the JPEG decoder's 1/2, 1/4 and 1/8 scales where possible.
+
+        Args:
+            image_path (str): Path to the image.
+            reduction (float): Largest acceptable ratio of original to decoded size.
+
+        Returns:
+            tuple: (image, factor) where image is the orientation-corrected Pillow
+            image and factor is the ratio of original to decoded size.
+        """
+        with Image.open(image_path) as image:
+            original_side = max(image.size)
+            image.draft(
+                "RGB",
+                (
+                    max(1, int(image.width / reduction)),
+                    max(1, int(image.height / reduction)),
+                ),
+            )
+            decoded = ImageOps.exif_transpose(image)
+        return decoded, original_side / max(decoded.size)
+
+    @staticmethod
+    def to_bgr(image):
+        """
+        Converts an RGB Pillow image to the BGR array DeepFace expects.
+
+        Args:
+            image (PIL.Image.Image): RGB image.
+
+        Returns:
+            numpy.ndarray: The image in OpenCV's BGR channel order.
+        """
+        return np.ascontiguousarray(np.asarray(image)[:, :, ::-1])
+
+    def load_for_detection(self, image_path, max_side=None):
+        """
+        Loads the image at no more than detection_max_side pixels on its longest edge.
+
+        JPEGs are decoded at reduced size directly, so the full-resolution
+        bitmap is never materialised.
+
+        Args:
+            image_path (str): Path to the image to be analyzed.
+            max_side (int): Overrides detection_max_side when given.
+
+        Returns:
+            tuple: (image, scale) where image is a BGR array or the original path
+            and scale maps detection coordinates back to the original image.
+        """
+        if max_side is None:
+            max_side = self.detection_max_side
+        if max_side <= 0:
+            return image_path, 1.0
+
+        try:
+            with Image.open(image_path) as image:
+                original_side = max(image.size)
+                if original_side <= max_side:
+                    return image_path, 1.0
+                image.draft("RGB", (max_side, max_side))
+                small = ImageOps.exif_transpose(image).convert("RGB")
+        except (UnidentifiedImageError, OSError):
+            # Let DeepFace read (and report on) anything Pillow cannot decode.
+            return image_path, 1.0
+
+        small.thumbnail((max_side, max_side))
+        return self.to_bgr(small), original_side / max(small.size)
+
+    @staticmethod
+    def scale_regions(results, scale):
+        """
+        Maps face regions found on a downscaled image back to the original size.
+
+        Args:
+            results (list or dict): DeepFace analysis results.
+            scale (float): Ratio of original to analyzed image size.
+
+        Returns:
+            list or dict: The results with rescaled regions.
+        """
+        if scale == 1.0 or not results:
+            return results
+
+        faces = results if isinstance(results, list) else [results]
+        for face in faces:
+            region = face.get("region")
+            if isinstance(region, dict):
+                for key in ("x", "y", "w", "h"):
+                    if key in region:
+                        region[key] = int(round(region[key] * scale))
+                # Eye positions are (x, y) points, or None when not detected.
+                for key in ("left_eye", "right_eye"):
+                    if isinstance(region.get(key), (list, tuple)):
+                        region[key] = tuple(
+                            int(round(value * scale)) for value in region[key]
+                        )
+        return results
+
     def validate_config(self):
         """
         Validates the configuration settings.
@@ -50,4 +252,7 @@ class FaceAnalyzer:
         if not self.config.DEEPFACE_MODELS or not self.config.DEEPFACE_BACKEND:
             logging.error("Invalid configuration: Missing required settings.")
             return False
+        if self.config.get_profile(self.config.DEFAULT_PROFILE) is None:
+            logging.error("Invalid configuration: Unknown DEFAULT_PROFILE.")
+            return False
         return True
@@ -0,0 +1,177 @@
+"""
+This module provides a RetentionSweeper class that applies retention policies
+to the analyses collection and reclaims orphaned image blobs and stale temp files.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from pymongo.errors import OperationFailure, PyMongoError
+from config import Config
+
+# Temp files written by the analyze endpoint are named "<uuid4><ext>".
+TEMP_FILE_PATTERN = re.compile(r"^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}\.\w+$")
+
+
+class RetentionSweeper:
+    """
+    A class to expire old analyses and reconcile the blobs and files they reference.
+    """
+
+    def __init__(self, database, on_image_removed=None):
+        """
+        Initializes the sweeper with the database the ML client writes to.
+
+        Args:
+            database (Database): The MongoDB database holding analyses and images.
+            on_image_removed (callable): Called with the analysis_id of every
+                orphaned image deleted, e.g. to drop it from caches.
+        """
+        self.database = database
+        self.on_image_removed = on_image_removed
+        self.config = Config()
+        self._stop_event = None
+
+    def ensure_ttl_index(self):
+        """
+        Creates (or updates) the TTL index on analyses.timestamp.
+
+        Returns:
+            str: The index name, or None if no TTL is configured or MongoDB
+                could not be reached (the error is logged and startup continues).
+        """
+        if self.config.ANALYSIS_TTL_DAYS <= 0:
+            return None
+
+        seconds = self.config.ANALYSIS_TTL_DAYS * 24 * 60 * 60
+        try:
+            try:
+                return self.database.analyses.create_index(
+                    "timestamp", name="timestamp_ttl", expireAfterSeconds=seconds
+                )
+            except OperationFailure:
+                # The index already exists with a different expiry; adjust it in place.
+                self.database.command(
+                    "collMod",
+                    "analyses",
+                    index={
+                        "keyPattern": {"timestamp": 1},
+                        "expireAfterSeconds": seconds,
+                    },
+                )
+                return "timestamp_ttl"
+        except PyMongoError as e:
+            logging.error("Cannot create the analyses TTL index: %s", str(e))
+            return None
+
+    def sweep_temp_files(self):
+        """
+        Deletes temp files older than the grace period. The analyze endpoint
+        removes its files itself, so these are left over from interrupted requests.
+
+        Returns:
+            tuple: (files_removed, bytes_reclaimed)
+        """
+        removed, reclaimed = 0, 0
+        cutoff = time.time() - self.config.TEMP_FILE_GRACE_SECONDS
+        try:
+            entries = list(os.scandir(self.config.TEMP_DIR))
+        except OSError as e:
+            logging.error("Cannot scan temp dir: %s", str(e))
+            return removed, reclaimed
+
+        for entry in entries:
+            if not TEMP_FILE_PATTERN.match(entry.name) or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+                if stat.st_mtime >= cutoff:
+                    continue
+                os.remove(entry.path)
+            except OSError:
+                continue
+            removed += 1
+            reclaimed += stat.st_size
+        return removed, reclaimed
+
+    def sweep_orphaned_images(self):
+        """
+        Deletes stored images whose analysis no longer exists (e.g. expired by TTL).
+
+        Returns:
+            tuple: (images_removed, bytes_reclaimed)
+        """
+        removed, reclaimed = 0, 0
+        image_ids = self.database.images.distinct(
+            "analysis_id", {"analysis_id": {"$exists": True}}
+        )
+        if not image_ids:
+            return removed, reclaimed
+
+        live_ids = set(
+            self.database.analyses.distinct(
+                "analysis_id", {"analysis_id": {"$in": image_ids}}
+            )
+        )
+        for analysis_id in image_ids:
+            if analysis_id in live_ids:
+                continue
+            doc = self.database.images.find_one_and_delete({"analysis_id": analysis_id})
+            if doc is not None:
+                removed += 1
+                reclaimed += len(doc.get("data") or b"")
+                if self.on_image_removed is not None:
+                    self.on_image_removed(analysis_id)
+        return removed, reclaimed
+
+    def run_once(self):
+        """
+        Runs a full retention pass and logs how much was reclaimed.
+
+        Returns:
+            dict: A report of removed files/images and bytes reclaimed, or None on error.
+        """
+        try:
+            files_removed, file_bytes = self.sweep_temp_files()
+            images_removed, image_bytes = self.sweep_orphaned_images()
+        except PyMongoError as e:
+            logging.error("Retention run failed: %s", str(e))
+            return None
+
+        report = {
+            "temp_files_removed": files_removed,
+            "images_removed": images_removed,
+            "bytes_reclaimed": file_bytes + image_bytes,
+        }
+        logging.info("Retention run: %s", report)
+        return report
+
+    def start(self):
+        """
+        Starts a daemon thread running the sweeper every RETENTION_INTERVAL_SECONDS.
+
+        Returns:
+            bool: True if the worker was started, False if it is disabled.
+        """
+        interval = self.config.RETENTION_INTERVAL_SECONDS
+        if interval <= 0 or self._stop_event is not None:
+            return False
+
+        stop_event = self._stop_event = threading.Event()
+
+        def worker():
+            while not stop_event.wait(interval):
+                self.run_once()
+
+        threading.Thread(target=worker, name="retention", daemon=True).start()
+        return True
+
+    def stop(self):
+        """
+        Stops the background worker if it is running.
+        """
+        if self._stop_event is not None:
+            self._stop_event.set()
+            self._stop_event = None
@@ -3,15 +3,28 @@ Module for testing the machine learning client components.
 """
 
 import io
+import json
 import os
 import sys
+import threading
+from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
+import pytest
+from flask import Flask, g
+from PIL import Image
+from pymongo.errors import ServerSelectionTimeoutError
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "src"))
 # pylint: disable=unused-import, import-error, wrong-import-position
 from config import Config
 from db_handler import DBHandler
 from face_analyzer import FaceAnalyzer
+from retention import RetentionSweeper
+import profiler
+import cache
+import capture
+import compact_results
+import app as app_module
 from app import app
 
 
@@ -38,6 +51,77 @@ class TestFaceAnalyzer:
         result = analyzer.analyze("fake.jpg")
         assert result is None
 
+    @patch("src.face_analyzer.DeepFace.extract_faces")
+    @patch("src.face_analyzer.DeepFace.analyze")
+    def test_analyze_downscales_large_image(self, mock_analyze, mock_extract, tmp_path):
+        """Test that faces are found downscaled and analyzed on full-size crops."""
+        image_path = tmp_path / "large.jpg"
+        Image.new("RGB", (4000, 3000), color="white").save(image_path)
+        mock_extract.return_value = [
+            {
+                "facial_area": {
+                    "x": 10,
+                    "y": 20,
+                    "w": 50,
+                    "h": 40,
+                    "left_eye": (20, 30),
+                    "right_eye": None,
+                },
+                "confidence": 0.98,
+            }
+        ]
+        mock_analyze.return_value = [
+            {"emotion": {"happy": 90.0}, "region": {"x": 0, "y": 0, "w": 1, "h": 1}}
+        ]
+
+        result = FaceAnalyzer(detection_max_side=1000).analyze(str(image_path))
+
+        assert mock_extract.call_args.kwargs["img_path"].shape == (750, 1000, 3)
+        crop_kwargs = mock_analyze.call_args.kwargs
+        assert crop_kwargs["img_path"].shape == (160, 200, 3)
+        assert crop_kwargs["detector_backend"] == "skip"
+        assert result[0]["emotion"] == {"happy": 90.0}
+        assert result[0]["region"] == {
+            "x": 40,
+            "y": 80,
+            "w": 200,
+            "h": 160,
+            "left_eye": (80, 120),
+            "right_eye": None,
+        }
+        assert result[0]["face_confidence"] == 0.98
+
+    @patch("src.face_analyzer.DeepFace.extract_faces")
+    @patch("src.face_analyzer.DeepFace.analyze")
+    def test_analyze_large_face_crops_reduced_decode(
+        self, mock_analyze, mock_extract, tmp_path
+    ):
+        """Test that large faces are cropped from a reduced-scale JPEG decode."""
+        image_path = tmp_path / "large.jpg"
+        Image.new("RGB", (4000, 3000), color="white").save(image_path)
+        mock_extract.return_value = [
+            {"facial_area": {"x": 100, "y": 100, "w": 500, "h": 500}, "confidence": 1}
+        ]
+        mock_analyze.return_value = [{"emotion": {"happy": 90.0}}]
+
+        result = FaceAnalyzer(detection_max_side=1000).analyze(str(image_path))
+
+        # The 2000px face is decoded at 1/8 scale, still above the model input.
+        assert mock_analyze.call_args.kwargs["img_path"].shape == (250, 250, 3)
+        assert result[0]["region"] == {"x": 400, "y": 400, "w": 2000, "h": 2000}
+
+    @patch("src.face_analyzer.DeepFace.analyze")
+    def test_analyze_small_image_uses_path(self, mock_analyze, tmp_path):
+        """Test that images within the max side are passed through untouched."""
+        image_path = tmp_path / "small.jpg"
+        Image.new("RGB", (640, 480), color="white").save(image_path)
+        mock_analyze.return_value = [{"region": {"x": 1, "y": 2, "w": 3, "h": 4}}]
+
+        result = FaceAnalyzer(detection_max_side=1000).analyze(str(image_path))
+
+        assert mock_analyze.call_args.kwargs["img_path"] == str(image_path)
+        assert result[0]["region"] == {"x": 1, "y": 2, "w": 3, "h": 4}
+
 
 class TestDbHandler:
     """Test suite for the DBHandler class."""
@@ -156,3 +240,392 @@ class TestAppAnalysisEndpoint:
             assert response.status_code == 404
             json_resp = response.get_json()
             assert "error" in json_resp
+
+
+class TestReadiness:
+    """Tests for the GET /ready endpoint probed by the web app's load balancer."""
+
+    @patch.object(app_module, "analyzer")
+    def test_ready(self, mock_analyzer):
+        """Test that a configured analyzer reports ready."""
+        mock_analyzer.validate_config.return_value = True
+        with app.test_client() as client:
+            response = client.get("/ready")
+            assert response.status_code == 200
+
+    @patch.object(app_module, "analyzer")
+    def test_not_ready(self, mock_analyzer):
+        """Test that a misconfigured analyzer is reported as unavailable."""
+        mock_analyzer.validate_config.return_value = False
+        with app.test_client() as client:
+            response = client.get("/ready")
+            assert response.status_code == 503
+
+
+class TestRetentionSweeper:
+    """Test suite for the RetentionSweeper class."""
+
+    def test_ensure_ttl_index_disabled(self):
+        """Test that no TTL index is created when ANALYSIS_TTL_DAYS is 0."""
+        mock_db = MagicMock()
+        with patch.object(Config, "ANALYSIS_TTL_DAYS", 0):
+            assert RetentionSweeper(mock_db).ensure_ttl_index() is None
+        mock_db.analyses.create_index.assert_not_called()
+
+    def test_ensure_ttl_index_unreachable_database(self):
+        """Test that an unreachable database is logged instead of failing startup."""
+        mock_db = MagicMock()
+        mock_db.analyses.create_index.side_effect = ServerSelectionTimeoutError("down")
+        with patch.object(Config, "ANALYSIS_TTL_DAYS", 1):
+            assert RetentionSweeper(mock_db).ensure_ttl_index() is None
+
+    def test_sweep_temp_files_removes_stale_files(self, tmp_path):
+        """Test that only temp files older than the grace period are deleted."""
+        stale = tmp_path / "11111111-1111-1111-1111-111111111111.jpg"
+        fresh = tmp_path / "22222222-2222-2222-2222-222222222222.jpg"
+        unrelated = tmp_path / "keep-me.jpg"
+        for path in (stale, fresh, unrelated):
+            path.write_bytes(b"x" * 10)
+        os.utime(stale, (0, 0))
+        os.utime(unrelated, (0, 0))
+
+        with patch.object(Config, "TEMP_DIR", str(tmp_path)):
+            assert RetentionSweeper(MagicMock()).sweep_temp_files() == (1, 10)
+        assert not stale.exists()
+        assert fresh.exists()
+        assert unrelated.exists()
+
+    def test_run_once_reports_bytes_reclaimed(self, tmp_path):
+        """Test that images without a live analysis are deleted and counted."""
+        mock_db = MagicMock()
+        mock_db.images.distinct.return_value = ["live", "expired"]
+        mock_db.analyses.distinct.return_value = ["live"]
+        mock_db.images.find_one_and_delete.return_value = {"data": b"y" * 25}
+        removed = []
+        with patch.object(Config, "TEMP_DIR", str(tmp_path)):
+            report = RetentionSweeper(mock_db, removed.append).run_once()
+        mock_db.images.find_one_and_delete.assert_called_once_with(
+            {"analysis_id": "expired"}
+        )
+        assert removed == ["expired"]
+        assert report == {
+            "temp_files_removed": 0,
+            "images_removed": 1,
+            "bytes_reclaimed": 25,
+        }
+
+
+# pylint: disable=too-few-public-methods
+class TestProfiler:
+    """Tests for the opt-in profiling hooks."""
+
+    def test_speedscope_document(self):
+        """Test that collected samples convert to a speedscope sampled profile."""
+        sampler = profiler.SamplingProfiler(interval=0.01)
+        stack = (("main", "app.py", 1), ("analyze", "face_analyzer.py", 30))
+        sampler.samples[stack] = 3
+        sampler.duration = 0.05
+
+        document = sampler.speedscope("test")
+
+        assert [f["name"] for f in document["shared"]["frames"]] == ["main", "analyze"]
+        assert document["profiles"][0]["samples"] == [[0, 1]]
+        assert document["profiles"][0]["weights"] == [0.03]
+
+    def test_profile_stopped_when_view_raises(self, tmp_path):
+        """Test that a profiled request whose view raises does not leak its sampler."""
+        profiled_app = Flask(__name__)
+        profiled_app.testing = True
+        with patch.object(profiler, "PROFILING_ENABLED", True), patch.object(
+            profiler, "PROFILE_TOKEN", "secret"
+        ), patch.object(profiler, "PROFILE_DIR", str(tmp_path)):
+            profiler.install(profiled_app)
+
+            @profiled_app.route("/boom")
+            def boom():
+                raise RuntimeError("boom")
+
+            with profiled_app.test_client() as client:
+                with pytest.raises(RuntimeError):
+                    client.get(
+                        "/boom",
+                        headers={"X-Profile": "1", "X-Profile-Token": "secret"},
+                    )
+
+        assert not any(
+            thread.name == "sampling-profiler" for thread in threading.enumerate()
+        )
+        assert len(os.listdir(tmp_path)) == 1
+
+
+class TestCaching:
+    """Tests for cached, conditional GET responses."""
+
+    def test_get_analysis_cached_and_conditional(self):
+        """Test that analyses are read once and revalidations return 304."""
+        mock_database = MagicMock()
+        mock_database.get_analysis.return_value = {"analysis_id": "abc", "results": []}
+        with patch.object(app_module, "database", mock_database), patch.object(
+            app_module, "document_cache", cache.ReadThroughCache(directory="")
+        ):
+            with app.test_client() as client:
+                first = client.get("/analysis/abc")
+                second = client.get("/analysis/abc")
+                revalidated = client.get(
+                    "/analysis/abc", headers={"If-None-Match": first.headers["ETag"]}
+                )
+
+        assert (
+            first.get_json()
+            == second.get_json()
+            == {
+                "analysis_id": "abc",
+                "results": [],
+            }
+        )
+        assert "immutable" in first.headers["Cache-Control"]
+        assert revalidated.status_code == 304
+        mock_database.get_analysis.assert_called_once_with("abc")
+
+    def test_analysis_cache_bounded_by_ttl(self):
+        """Test that analyses past ANALYSIS_TTL_DAYS are neither cached nor kept."""
+        mock_database = MagicMock()
+        mock_database.get_analysis.return_value = {
+            "analysis_id": "old",
+            "results": [],
+            "timestamp": datetime.utcnow() - timedelta(days=3),
+        }
+        with patch.object(app_module, "database", mock_database), patch.object(
+            app_module, "document_cache", cache.ReadThroughCache(directory="")
+        ), patch.object(Config, "ANALYSIS_TTL_DAYS", 2):
+            with app.test_client() as client:
+                first = client.get("/analysis/old")
+                client.get("/analysis/old")
+
+        assert first.headers["Cache-Control"].count("max-age=0") == 1
+        assert mock_database.get_analysis.call_count == 2
+
+    def test_revalidation_bounded_by_ttl(self):
+        """Test that 304s carry the TTL-bounded max-age and need a known analysis."""
+        mock_database = MagicMock()
+        mock_database.get_analysis.side_effect = lambda analysis_id: (
+            {"analysis_id": "abc", "results": [], "timestamp": datetime.utcnow()}
+            if analysis_id == "abc"
+            else None
+        )
+        with patch.object(app_module, "database", mock_database), patch.object(
+            app_module, "document_cache", cache.ReadThroughCache(directory="")
+        ), patch.object(Config, "ANALYSIS_TTL_DAYS", 1):
+            with app.test_client() as client:
+                revalidated = client.get(
+                    "/analysis/abc", headers={"If-None-Match": 'W/"analysis-abc"'}
+                )
+                unknown = client.get(
+                    "/analysis/gone", headers={"If-None-Match": 'W/"analysis-gone"'}
+                )
+
+        assert revalidated.status_code == 304
+        assert 86000 < revalidated.cache_control.max_age <= 86400
+        assert unknown.status_code == 404
+
+    def test_get_image_not_marked_no_cache(self):
+        """Test that stored images are served immutable without send_file's no-cache."""
+        images = MagicMock()
+        images.find_one.return_value = {
+            "data": b"jpeg",
+            "content_type": "image/jpeg",
+            "filename": "a.jpg",
+        }
+        with patch.object(app, "images_collection", images), patch.object(
+            app_module, "document_cache", cache.ReadThroughCache(directory="")
+        ):
+            with app.test_client() as client:
+                response = client.get("/uploads/abc")
+
+        assert response.status_code == 200
+        assert "immutable" in response.headers["Cache-Control"]
+        assert "no-cache" not in response.headers["Cache-Control"]
+
+    def test_missing_analysis_is_not_cached(self):
+        """Test that a 404 lookup is retried on the next request."""
+        mock_database = MagicMock()
+        mock_database.get_analysis.return_value = None
+        with patch.object(app_module, "database", mock_database), patch.object(
+            app_module, "document_cache", cache.ReadThroughCache(directory="")
+        ):
+            with app.test_client() as client:
+                assert client.get("/analysis/missing").status_code == 404
+                assert client.get("/analysis/missing").status_code == 404
+        assert mock_database.get_analysis.call_count == 2
+
+
+class TestCapture:
+    """Tests for the traffic capture middleware."""
+
+    def test_json_image_captured_by_hash(self, tmp_path):
+        """Test that base64 images in JSON bodies are recorded as hash references."""
+        capture_path = tmp_path / "requests.jsonl"
+        with patch.object(capture, "CAPTURE_PATH", str(capture_path)), patch.object(
+            capture, "CAPTURE_BLOB_DIR", ""
+        ):
+            with app.test_request_context(
+                "/", method="POST", json={"image": "data:image/jpeg;base64,AAAA"}
+            ):
+                record = capture.describe_request()
+                capture.write_record(record)
+
+        written = capture_path.read_text(encoding="utf-8")
+        assert "AAAA" not in written
+        assert record["service"] == "machine-learning-client"
+        assert record["json"]["image"]["data_url"] == {
+            "sha256": "709e80c88487a2411e1ee4dfb9f22a861492d20c4765150c0c794abd70f8147c",
+            "size": 3,
+            "content_type": "image/jpeg",
+        }
+
+    def test_capture_failure_drops_sample(self, tmp_path):
+        """Test that an unwritable blob directory drops the sample, not the request."""
+        not_a_dir = tmp_path / "blobs"
+        not_a_dir.write_text("", encoding="utf-8")
+        with patch.object(capture, "CAPTURE_SAMPLE_RATE", 1.0), patch.object(
+            capture, "CAPTURE_BLOB_DIR", str(not_a_dir)
+        ):
+            with app.test_request_context(
+                "/", method="POST", json={"image": "data:image/jpeg;base64,AAAA"}
+            ):
+                capture._start_capture()  # pylint: disable=protected-access
+                assert "capture_record" not in g
+
+
+DEEPFACE_FACE = {
+    "age": 31,
+    "region": {"x": 5, "y": 6, "w": 70, "h": 80, "left_eye": None, "right_eye": None},
+    "gender": {"Woman": 97.25, "Man": 2.75},
+    "dominant_gender": "Woman",
+    "emotion": {
+        "angry": 0.5,
+        "disgust": 0.0,
+        "fear": 1.5,
+        "happy": 88.0,
+        "sad": 2.0,
+        "surprise": 3.0,
+        "neutral": 5.0,
+    },
+    "dominant_emotion": "happy",
+}
+
+
+class TestCompactResults:
+    """Tests for the compact DeepFace result format."""
+
+    def test_round_trip_preserves_dominant_labels(self):
+        """Test that compact results expand back to the legacy shape."""
+        compact = compact_results.compact([DEEPFACE_FACE])
+        assert compact["v"] == compact_results.WIRE_VERSION
+        assert compact["faces"][0][0] == [5, 6, 70, 80]
+
+        face = compact_results.expand(compact)[0]
+        assert face["region"] == {"x": 5, "y": 6, "w": 70, "h": 80}
+        assert face["age"] == 31
+        assert face["dominant_gender"] == "Woman"
+        assert face["dominant_emotion"] == "happy"
+        assert abs(face["emotion"]["happy"] - 88.0) < 0.5
+        assert len(json.dumps(compact)) < len(json.dumps([DEEPFACE_FACE])) / 2
+
+    def test_missing_actions_and_legacy_passthrough(self):
+        """Test that unanalyzed attributes are null and legacy results pass through."""
+        compact = compact_results.compact({"region": {"x": 1, "y": 2, "w": 3, "h": 4}})
+        assert compact["faces"] == [[[1, 2, 3, 4], None, None, None]]
+        assert compact_results.expand(compact) == [
+            {"region": {"x": 1, "y": 2, "w": 3, "h": 4}}
+        ]
+        assert compact_results.expand("Error during prediction") == (
+            "Error during prediction"
+        )
+
+    def test_analyze_json_compact_format(self, tmp_path):
+        """Test that JSON callers asking for the compact format receive and store it."""
+        mock_analyzer = MagicMock()
+        mock_analyzer.analyze.return_value = [DEEPFACE_FACE]
+        mock_database = MagicMock()
+        mock_database.store_analysis.return_value = "abc"
+        with patch.object(app_module, "analyzer", mock_analyzer), patch.object(
+            app_module, "database", mock_database
+        ), patch.object(Config, "TEMP_DIR", str(tmp_path)):
+            with app.test_client() as client:
+                response = client.post(
+                    "/",
+                    json={"image": "data:image/jpeg;base64,AAAA", "format": "compact"},
+                )
+
+        expected = compact_results.compact([DEEPFACE_FACE])
+        assert response.status_code == 200
+        assert response.get_json()["results"] == expected
+        assert mock_database.store_analysis.call_args.args[1] == expected
+        # The uploaded image is deleted once it has been analyzed.
+        assert not list(tmp_path.iterdir())
+
+
+class TestProfiles:
+    """Tests for per-request action selection and performance profiles."""
+
+    def post_json(self, tmp_path, body):
+        """POST body to the analyze route with a mocked analyzer and database."""
+        mock_analyzer = MagicMock()
+        mock_analyzer.analyze.return_value = [DEEPFACE_FACE]
+        mock_database = MagicMock()
+        mock_database.store_analysis.return_value = "abc"
+        with patch.object(app_module, "analyzer", mock_analyzer), patch.object(
+            app_module, "database", mock_database
+        ), patch.object(Config, "TEMP_DIR", str(tmp_path)):
+            with app.test_client() as client:
+                response = client.post(
+                    "/", json=dict(body, image="data:image/jpeg;base64,AAAA")
+                )
+        return response, mock_analyzer, mock_database
+
+    def test_fast_profile(self, tmp_path):
+        """Test that the fast profile runs emotion only on the fast detector."""
+        with patch.object(Config, "FAST_PROFILE_BACKEND", "opencv"), patch.object(
+            Config, "FAST_PROFILE_MODELS", ["emotion"]
+        ):
+            response, analyzer, database = self.post_json(tmp_path, {"profile": "fast"})
+
+        assert response.status_code == 200
+        assert response.get_json()["profile"] == "fast"
+        assert response.get_json()["models"] == ["emotion"]
+        kwargs = analyzer.analyze.call_args.kwargs
+        assert kwargs["actions"] == ["emotion"]
+        assert kwargs["detector_backend"] == "opencv"
+        assert database.store_analysis.call_args.kwargs["profile"] == "fast"
+
+    def test_actions_override_profile(self, tmp_path):
+        """Test that explicit actions replace the profile's actions."""
+        response, analyzer, _ = self.post_json(tmp_path, {"actions": ["age"]})
+        assert response.status_code == 200
+        assert response.get_json()["profile"] == Config.DEFAULT_PROFILE
+        assert analyzer.analyze.call_args.kwargs["actions"] == ["age"]
+
+    def test_invalid_choices_rejected(self, tmp_path):
+        """Test that unknown profiles and actions are rejected before analysis."""
+        bodies = (
+            {"profile": "turbo"},
+            {"profile": ["fast"]},
+            {"actions": ["race"]},
+            {"actions": []},
+            {"actions": [{"emotion": 1}]},
+        )
+        for body in bodies:
+            response, analyzer, _ = self.post_json(tmp_path, body)
+            assert response.status_code == 400
+            analyzer.analyze.assert_not_called()
+
+    @patch("src.face_analyzer.DeepFace.analyze")
+    def test_analyze_overrides(self, mock_analyze):
+        """Test that analyze() passes action and detector overrides to DeepFace."""
+        mock_analyze.return_value = [{"emotion": {"happy": 0.9}}]
+        FaceAnalyzer(detection_max_side=0).analyze(
+            "fake.jpg", actions=["emotion"], detector_backend="ssd"
+        )
+        assert mock_analyze.call_args.kwargs["actions"] == ["emotion"]
+        assert mock_analyze.call_args.kwargs["detector_backend"] == "ssd"
@@ -0,0 +1,333 @@
+"""
+Replays traffic captured by the web app and ML client capture middleware.
+
+Reads JSON-lines request logs (one request per line, keyed by request_id, as
+written to CAPTURE_PATH), reissues them against the running services at the
+recorded pace or a multiple of it, and reports throughput and latency,
+flagging paths whose latency regressed against the capture or a saved baseline.
+
+A stand-in ML backend can be started with --stub-ml-port so the web app can be
+load tested without DeepFace (point the web app's ML_CLIENT_URL at it).
+
+Usage:
+    python tools/replay.py capture.jsonl --web-url http://localhost:5001 \\
+        --ml-url http://localhost:5002 --blob-dir /tmp/capture/blobs --speed 4
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+STUB_RESULTS = [
+    {
+        "age": 30,
+        "dominant_gender": "Woman",
+        "gender": {"Woman": 90.0, "Man": 10.0},
+        "dominant_emotion": "happy",
+        "emotion": {
+            "angry": 1.0,
+            "disgust": 0.0,
+            "fear": 1.0,
+            "happy": 90.0,
+            "sad": 2.0,
+            "surprise": 3.0,
+            "neutral": 3.0,
+        },
+        "region": {"x": 10, "y": 10, "w": 100, "h": 100},
+    }
+]
+
+
+def load_records(path, service=None):
+    """Reads captured requests, optionally keeping only one service's traffic."""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if service is None or record.get("service") == service:
+                records.append(record)
+    records.sort(key=lambda record: record["timestamp"])
+    return records
+
+
+def placeholder_image(size):
+    """Builds a JPEG of roughly the given byte size for blobs that were not stored."""
+    side = max(16, int((size or 4096) ** 0.5))
+    buffer = io.BytesIO()
+    Image.effect_noise((side, side), 64).convert("RGB").save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def blob_bytes(reference, blob_dir):
+    """Returns the bytes for a captured blob reference."""
+    if blob_dir and reference.get("ref"):
+        path = os.path.join(blob_dir, reference["ref"])
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+    return placeholder_image(reference.get("size"))
+
+
+def restore_value(value, blob_dir):
+    """Turns a captured data URL reference back into a base64 data URL."""
+    if isinstance(value, dict) and "data_url" in value:
+        reference = value["data_url"]
+        encoded = base64.b64encode(blob_bytes(reference, blob_dir)).decode("ascii")
+        return f"data:{reference.get('content_type') or 'image/jpeg'};base64,{encoded}"
+    return value
+
+
+def build_request(record, base_url, blob_dir):
+    """Returns the keyword arguments for requests.request() reissuing record."""
+    url = base_url.rstrip("/") + record["path"]
+    if record.get("query"):
+        url += "?" + record["query"]
+    kwargs = {"method": record["method"], "url": url, "allow_redirects": False}
+    if "json" in record:
+        body = record["json"]
+        if isinstance(body, dict):
+            body = {key: restore_value(value, blob_dir) for key, value in body.items()}
+        kwargs["json"] = body
+    if "form" in record or "files" in record:
+        kwargs["data"] = {
+            key: restore_value(value, blob_dir)
+            for key, value in record.get("form", {}).items()
+        }
+        kwargs["files"] = {
+            key: (
+                reference.get("filename") or key,
+                blob_bytes(reference, blob_dir),
+                reference.get("content_type") or "application/octet-stream",
+            )
+            for key, reference in record.get("files", {}).items()
+        }
+    return kwargs
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return round(ordered[index], 3)
+
+
+def latency_summary(latencies):
+    """Summarises a list of latencies in milliseconds."""
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.mean(latencies), 3) if latencies else None,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def pooled_session(size):
+    """Returns a requests session whose connection pool fits `size` workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def replay(records, targets, blob_dir, speed, concurrency):
+    """
+    Reissues records, preserving their relative timing divided by speed
+    (speed 0 sends as fast as the worker pool allows).
+    Returns a list of (record, status, latency_ms) tuples.
+    """
+    first = datetime.fromisoformat(records[0]["timestamp"])
+    session = pooled_session(concurrency)
+    results = []
+    lock = threading.Lock()
+
+    def send(record):
+        kwargs = build_request(record, targets[record["service"]], blob_dir)
+        start = time.perf_counter()
+        try:
+            status = session.request(timeout=120, **kwargs).status_code
+        except requests.RequestException:
+            status = None
+        latency = (time.perf_counter() - start) * 1000
+        with lock:
+            results.append((record, status, latency))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            if record.get("service") not in targets:
+                continue
+            if speed > 0:
+                offset = (
+                    datetime.fromisoformat(record["timestamp"]) - first
+                ).total_seconds() / speed
+                delay = offset - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, record)
+    return results
+
+
+def build_report(results, elapsed, regression_threshold, baseline=None):
+    """Builds the replay report, comparing each endpoint with its recorded latency."""
+    by_endpoint = {}
+    for record, status, latency in results:
+        key = f"{record['service']} {record['method']} {record['path']}"
+        entry = by_endpoint.setdefault(key, {"replayed": [], "recorded": []})
+        entry["replayed"].append(latency)
+        if record.get("latency_ms") is not None:
+            entry["recorded"].append(record["latency_ms"])
+        if status is None or status >= 500:
+            entry["errors"] = entry.get("errors", 0) + 1
+
+    endpoints, regressions = {}, []
+    for key, entry in sorted(by_endpoint.items()):
+        replayed = latency_summary(entry["replayed"])
+        replayed["errors"] = entry.get("errors", 0)
+        endpoints[key] = {
+            "replayed": replayed,
+            "recorded": latency_summary(entry["recorded"]),
+        }
+        reference = endpoints[key]["recorded"]["p95_ms"]
+        if baseline and key in baseline.get("endpoints", {}):
+            reference = baseline["endpoints"][key]["replayed"]["p95_ms"]
+        if reference and replayed["p95_ms"] > reference * (1 + regression_threshold):
+            regressions.append(
+                {
+                    "endpoint": key,
+                    "p95_ms": replayed["p95_ms"],
+                    "reference_ms": reference,
+                }
+            )
+
+    return {
+        "requests": len(results),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 3) if elapsed else None,
+        "errors": sum(
+            endpoint["replayed"]["errors"] for endpoint in endpoints.values()
+        ),
+        "endpoints": endpoints,
+        "regressions": regressions,
+    }
+
+
+class StubMLHandler(BaseHTTPRequestHandler):
+    """Stand-in for the ML client: accepts any image and returns fixed results."""
+
+    latency = 0.0
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answers readiness checks."""
+        self._send_json(200, {"status": "ready"})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Answers analysis requests after the configured latency."""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        self._send_json(
+            200,
+            {"analysis_id": "stub", "results": STUB_RESULTS, "models": ["emotion"]},
+        )
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keeps the stub quiet."""
+
+
+def start_stub_ml(port, latency_ms):
+    """Starts the stand-in ML backend on a background thread and returns its URL."""
+    handler = type("ConfiguredStubMLHandler", (StubMLHandler,), {})
+    handler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(("0.0.0.0", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://localhost:{server.server_address[1]}"
+
+
+def build_targets(args):
+    """Maps each service name to the base URL its records are replayed against."""
+    targets = {}
+    if args.stub_ml_port is not None:
+        targets["machine-learning-client"] = start_stub_ml(
+            args.stub_ml_port, args.stub_ml_latency_ms
+        )
+        print(f"Stub ML backend listening on {targets['machine-learning-client']}")
+    if args.web_url:
+        targets["web-app"] = args.web_url
+    if args.ml_url:
+        targets["machine-learning-client"] = args.ml_url
+    return targets
+
+
+def main():
+    """Parses arguments, replays the capture and prints the report."""
+    parser = argparse.ArgumentParser(description="Replay captured request logs.")
+    parser.add_argument("capture", help="JSON-lines file written by the capture hooks")
+    parser.add_argument("--web-url", help="base URL of the web app")
+    parser.add_argument("--ml-url", help="base URL of the ML client")
+    parser.add_argument("--blob-dir", help="directory of captured image blobs")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="rate multiplier (0 = unpaced)"
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--service", help="only replay this service's records")
+    parser.add_argument("--stub-ml-port", type=int, help="start a stand-in ML backend")
+    parser.add_argument("--stub-ml-latency-ms", type=float, default=50.0)
+    parser.add_argument("--baseline", help="earlier report to compare p95 against")
+    parser.add_argument("--regression-threshold", type=float, default=0.2)
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args()
+
+    targets = build_targets(args)
+    if not targets:
+        parser.error("give --web-url, --ml-url and/or --stub-ml-port")
+
+    records = load_records(args.capture, args.service)
+    if not records:
+        parser.error("no records to replay")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    start = time.perf_counter()
+    results = replay(records, targets, args.blob_dir, args.speed, args.concurrency)
+    report = build_report(
+        results, time.perf_counter() - start, args.regression_threshold, baseline
+    )
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    raise SystemExit(1 if report["regressions"] else 0)
+
+
+if __name__ == "__main__":
+    main()
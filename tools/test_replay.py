@@ -0,0 +1,90 @@
+"""
+Tests for the traffic replay tool.
+"""
+
+import base64
+import hashlib
+import io
+
+from PIL import Image
+
+import replay
+
+
+def make_record(latency_ms, service="web-app", path="/"):
+    """Build a minimal captured request record."""
+    return {
+        "request_id": "r",
+        "timestamp": "2025-01-01T00:00:00+00:00",
+        "service": service,
+        "method": "POST",
+        "path": path,
+        "latency_ms": latency_ms,
+    }
+
+
+def test_restore_value_reads_stored_blob(tmp_path):
+    """Test that data URL references are rebuilt from the blob directory."""
+    data = b"\xff\xd8stored"
+    digest = hashlib.sha256(data).hexdigest()
+    (tmp_path / digest).write_bytes(data)
+    reference = {"data_url": {"content_type": "image/png", "ref": digest}}
+
+    restored = replay.restore_value(reference, str(tmp_path))
+
+    assert restored == "data:image/png;base64," + base64.b64encode(data).decode()
+    assert replay.restore_value("plain", str(tmp_path)) == "plain"
+
+
+def test_restore_value_without_blob_uses_placeholder():
+    """Test that blobs that were not stored are replaced by a decodable JPEG."""
+    restored = replay.restore_value({"data_url": {"size": 2048}}, None)
+    header, encoded = restored.split(",", 1)
+    assert header == "data:image/jpeg;base64"
+    assert Image.open(io.BytesIO(base64.b64decode(encoded))).format == "JPEG"
+
+
+def test_build_request_json_and_files(tmp_path):
+    """Test that JSON and multipart records become equivalent request arguments."""
+    data = b"image-bytes"
+    digest = hashlib.sha256(data).hexdigest()
+    (tmp_path / digest).write_bytes(data)
+
+    json_record = dict(
+        make_record(1, service="machine-learning-client"),
+        query="format=compact",
+        json={"image": {"data_url": {"ref": digest}}, "format": "compact"},
+    )
+    kwargs = replay.build_request(json_record, "http://ml:5002/", str(tmp_path))
+    assert kwargs["url"] == "http://ml:5002/?format=compact"
+    assert kwargs["method"] == "POST"
+    assert kwargs["json"]["format"] == "compact"
+    assert kwargs["json"]["image"].endswith(base64.b64encode(data).decode())
+
+    form_record = dict(
+        make_record(1),
+        form={"captured_image": ""},
+        files={"image": {"ref": digest, "filename": "a.jpg", "content_type": "x/y"}},
+    )
+    kwargs = replay.build_request(form_record, "http://web:5001", str(tmp_path))
+    assert kwargs["data"] == {"captured_image": ""}
+    assert kwargs["files"] == {"image": ("a.jpg", data, "x/y")}
+
+
+def test_build_report_flags_regression_against_baseline():
+    """Test that p95 regressions beyond the threshold are reported per endpoint."""
+    results = [(make_record(10), 200, 30.0) for _ in range(20)]
+    results.append((make_record(10, path="/uploads/x"), 500, 5.0))
+    baseline = {"endpoints": {"web-app POST /": {"replayed": {"p95_ms": 20.0}}}}
+
+    report = replay.build_report(results, 2.0, 0.2, baseline)
+
+    assert report["requests"] == 21
+    assert report["errors"] == 1
+    assert report["throughput_rps"] == 10.5
+    assert report["regressions"] == [
+        {"endpoint": "web-app POST /", "p95_ms": 30.0, "reference_ms": 20.0}
+    ]
+
+    lenient = replay.build_report(results, 2.0, 0.6, baseline)
+    assert not lenient["regressions"]
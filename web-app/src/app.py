@@ -7,7 +7,6 @@ processes images with an ML client, and retrieves stored images.
 import os
 import io
 import base64
-from datetime import datetime
 
 import requests
 from flask import Flask, render_template, request, redirect, url_for, flash, send_file
@@ -20,19 +19,61 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Local modules read their settings at import time, so load .env first.
+# pylint: disable=wrong-import-position
+import cache
+import capture
+import ml_pool
+import near_duplicates
+import profiler
+import retention
+import uploads
+
 # Get configuration values from environment variables
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
+profiler.install(app)
+capture.install(app)
 
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DBNAME = os.getenv("MONGO_DBNAME")
-ML_CLIENT_URL = os.getenv("ML_CLIENT_URL")  # URL for the ML picture processing client
+# URL(s) for the ML picture processing client, comma-separated for several replicas
+ML_CLIENT_URL = os.getenv("ML_CLIENT_URL")
 MAX_IMAGE_SIZE = 16 * 1024 * 1024  # 16MB in bytes
 
 # Connect to the MongoDB database and use the 'images' collection to store image data
 client = MongoClient(MONGO_URI)
 db = client[MONGO_DBNAME]
 images_collection = db.images
+# Stored images never change once written, so lookups by ID can be cached.
+document_cache = cache.ReadThroughCache()
+
+# Spread ML requests across every ML client replica.
+ml_clients = ml_pool.MLPool.from_env(ML_CLIENT_URL)
+ml_clients.start_health_checks()
+# Recent uploads by perceptual hash, so near-identical frames reuse a prediction.
+recent_images = near_duplicates.NearDuplicateIndex()
+
+
+def find_image(image_id):
+    """
+    Looks up a stored image document by its ID through the document cache.
+    Raises InvalidId for malformed IDs and PyMongoError for database errors.
+    """
+    object_id = ObjectId(image_id)
+    return document_cache.get_or_load(
+        ("image", image_id),
+        lambda: images_collection.find_one({"_id": object_id}),
+        retention.image_expiry,
+    )
+
+
+# Expire and compact old uploads according to the configured retention policy.
+retention.ensure_ttl_index(images_collection, "upload_date", retention.IMAGE_TTL_DAYS)
+retention.start_retention_worker(
+    images_collection,
+    on_compacted=lambda image_id: document_cache.invalidate(("image", str(image_id))),
+)
 
 
 def load_image_from_request():
@@ -70,47 +111,56 @@ def load_image_from_request():
     return None, None
 
 
+def request_prediction(img_data):
+    """
+    Sends the JPEG to the ML client, using the fast analysis profile while the
+    ML clients are overloaded.
+    Returns (results or an error string, name of the profile used).
+    """
+    profile = ml_clients.choose_profile()
+    payload = uploads.prediction_payload(img_data, profile)
+
+    try:
+        ml_response = ml_clients.post(payload, timeout=30)
+        ml_response.raise_for_status()
+        body = ml_response.json()
+        return body.get("results", "No result"), body.get("profile", profile)
+    except requests.RequestException as req_err:
+        return f"Error during prediction: {req_err}", profile
+    except ValueError:
+        return "Error decoding ML response", profile
+
+
+@profiler.track_memory
 def process_upload(image_obj, filename):
     """
     Converts the image to JPEG, checks its size, sends it to the ML client,
     and stores the image and prediction in MongoDB.
     Returns the inserted document's ID as a string.
     """
-    if image_obj.mode in ("RGBA", "LA"):
-        image_obj = image_obj.convert("RGB")
-
-    image_bytes = io.BytesIO()
-    image_obj.save(image_bytes, format="JPEG")
-    img_data = image_bytes.getvalue()
+    img_data = uploads.encode_jpeg(image_obj)
 
     if len(img_data) > MAX_IMAGE_SIZE:
         flash("Uploaded image exceeds 16MB and cannot be stored!")
         return None
 
-    image_b64 = base64.b64encode(img_data).decode("utf-8")
-    payload = {"image": f"data:image/jpeg;base64,{image_b64}"}
-
-    try:
-        ml_response = requests.post(ML_CLIENT_URL, json=payload, timeout=30)
-        ml_response.raise_for_status()
-        prediction = ml_response.json().get("results", "No result")
-    except requests.RequestException as req_err:
-        prediction = f"Error during prediction: {req_err}"
-    except ValueError:
-        prediction = "Error decoding ML response"
+    image_hash = near_duplicates.dhash(image_obj)
+    original = recent_images.lookup(image_hash)
+    if original is None:
+        (prediction, profile), duplicate_of = request_prediction(img_data), None
+    else:
+        prediction, profile = original["prediction"], original["profile"]
+        duplicate_of = original["image_id"]
 
     print(prediction, flush=True)
 
     result = images_collection.insert_one(
-        {
-            "filename": filename,
-            "data": img_data,
-            "content_type": "image/jpeg",
-            "upload_date": datetime.utcnow(),
-            "prediction": prediction,
-        }
+        uploads.image_document(filename, img_data, prediction, profile, duplicate_of)
     )
-    return str(result.inserted_id)
+    new_id = str(result.inserted_id)
+    if duplicate_of is None:
+        recent_images.remember(image_hash, new_id, prediction, profile)
+    return new_id
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -135,8 +185,10 @@ def index():
     uploaded_id = request.args.get("uploaded")
     if uploaded_id:
         try:
-            file_doc = images_collection.find_one({"_id": ObjectId(uploaded_id)})
-            files = [file_doc] if file_doc is not None else []
+            file_doc = find_image(uploaded_id)
+            files = (
+                [uploads.expand_prediction(file_doc)] if file_doc is not None else []
+            )
         except (InvalidId, PyMongoError) as err:
             flash(f"Error retrieving image: {err}")
             files = []
@@ -153,7 +205,7 @@ def get_image(image_id):
     and returns it as a file.
     """
     try:
-        image_doc = images_collection.find_one({"_id": ObjectId(image_id)})
+        image_doc = find_image(image_id)
     except (InvalidId, PyMongoError) as err:
         flash(f"Error retrieving image: {err}")
         return redirect(url_for("index"))
@@ -162,13 +214,25 @@ def get_image(image_id):
         flash("Image not found!")
         return redirect(url_for("index"))
 
+    # Revalidations are answered from the (usually cached) document, so the 304
+    # is never cacheable for longer than the image itself.
+    if request.if_none_match.contains_weak(image_id):
+        return cache.not_modified(image_id, retention.image_expiry(image_doc))
+
     try:
-        return send_file(
+        response = send_file(
             io.BytesIO(image_doc["data"]),
             mimetype=image_doc.get("content_type", "image/jpeg"),
             as_attachment=False,
             download_name=image_doc.get("filename", "image.jpg"),
         )
+        cache.immutable_headers(
+            response,
+            image_id,
+            image_doc.get("upload_date"),
+            retention.image_expiry(image_doc),
+        )
+        return response.make_conditional(request)
     except Exception as send_err:  # pylint: disable=broad-exception-caught
         flash(f"Error sending image: {send_err}")
         return redirect(url_for("index"))
@@ -0,0 +1,264 @@
+"""
+Asynchronous (ASGI) variant of the web app.
+Serves the same routes and templates as app.py with Quart, talking to MongoDB
+through motor and to the ML client through a pooled httpx client, so an upload
+waiting on the ML round-trip does not hold an OS thread.
+Run with: hypercorn asgi_app:app --bind 0.0.0.0:5001
+"""
+
+import os
+import io
+import base64
+import asyncio
+
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Quart, render_template, request, redirect, url_for, flash, send_file
+from PIL import Image, UnidentifiedImageError
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from bson import ObjectId
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Local modules read their settings at import time, so load .env first.
+# pylint: disable=wrong-import-position
+import cache
+import ml_pool
+import near_duplicates
+import retention
+import uploads
+
+app = Quart(__name__)
+app.secret_key = os.getenv("SECRET_KEY")
+
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DBNAME = os.getenv("MONGO_DBNAME")
+# URL(s) for the ML picture processing client, comma-separated for several replicas
+ML_CLIENT_URL = os.getenv("ML_CLIENT_URL")
+ML_MAX_CONNECTIONS = int(os.getenv("ML_MAX_CONNECTIONS", "200"))
+MAX_IMAGE_SIZE = 16 * 1024 * 1024  # 16MB in bytes
+
+# Motor binds to the running event loop on first use.
+client = AsyncIOMotorClient(MONGO_URI)
+db = client[MONGO_DBNAME]
+images_collection = db.images
+# Stored images never change once written, so lookups by ID can be cached.
+document_cache = cache.ReadThroughCache()
+
+# The HTTP connection pool is created once the server's event loop is running.
+ml_http = {"client": None}
+# Replica selection and health checks are shared with the WSGI app.
+ml_clients = ml_pool.MLPool.from_env(ML_CLIENT_URL)
+ml_clients.start_health_checks()
+# Recent uploads by perceptual hash, so near-identical frames reuse a prediction.
+recent_images = near_duplicates.NearDuplicateIndex()
+
+# Retention runs on a background thread, so it keeps using a blocking client.
+if retention.IMAGE_TTL_DAYS > 0 or retention.RETENTION_INTERVAL_SECONDS > 0:
+    _retention_images = MongoClient(MONGO_URI)[MONGO_DBNAME].images
+    retention.ensure_ttl_index(
+        _retention_images, "upload_date", retention.IMAGE_TTL_DAYS
+    )
+    retention.start_retention_worker(
+        _retention_images,
+        on_compacted=lambda image_id: document_cache.invalidate(
+            ("image", str(image_id))
+        ),
+    )
+
+
+@app.before_serving
+async def open_ml_client():
+    """Creates the shared HTTP connection pool for ML client requests."""
+    ml_http["client"] = httpx.AsyncClient(
+        timeout=30,
+        limits=httpx.Limits(
+            max_connections=ML_MAX_CONNECTIONS,
+            max_keepalive_connections=ML_MAX_CONNECTIONS,
+        ),
+    )
+
+
+@app.after_serving
+async def close_ml_client():
+    """Closes the shared HTTP connection pool."""
+    if ml_http["client"] is not None:
+        await ml_http["client"].aclose()
+        ml_http["client"] = None
+
+
+def decode_image(data):
+    """
+    Opens image bytes with Pillow and fully decodes them.
+    Returns the image, or None if the data is not a valid image.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError):
+        return None
+    return image
+
+
+async def find_image(image_id):
+    """
+    Looks up a stored image document by its ID through the document cache.
+    Raises InvalidId for malformed IDs and PyMongoError for database errors.
+    """
+    object_id = ObjectId(image_id)
+    return await document_cache.get_or_load_async(
+        ("image", image_id),
+        lambda: images_collection.find_one({"_id": object_id}),
+        retention.image_expiry,
+    )
+
+
+async def load_image_from_request():
+    """
+    Processes the incoming request to load an image either from the uploaded file field
+    or from a base64-encoded captured image.
+    Returns a tuple (image, filename) or (None, None) on error.
+    """
+    files = await request.files
+    form = await request.form
+    file_obj = files.get("image")
+    captured = form.get("captured_image", "")
+
+    if file_obj and file_obj.filename:
+        image = await asyncio.to_thread(decode_image, file_obj.read())
+        if image is None:
+            await flash("Invalid image format!")
+            return None, None
+        return image, file_obj.filename
+
+    if captured:
+        parts = captured.split(",", 1)
+        if len(parts) != 2:
+            await flash("Invalid captured image data!")
+            return None, None
+        try:
+            image_data = base64.b64decode(parts[1])
+        except ValueError:
+            image_data = b""
+        image = await asyncio.to_thread(decode_image, image_data)
+        if image is None:
+            await flash("Invalid captured image format!")
+            return None, None
+        return image, "captured.jpg"
+
+    await flash("No file selected!")
+    return None, None
+
+
+async def request_prediction(payload):
+    """
+    Posts the payload to the ML client through the shared replica pool, which
+    retries and hedges like the WSGI app's.
+    Returns (results or an error string, name of the profile used).
+    """
+    profile = payload["profile"]
+    try:
+        ml_response = await ml_clients.post_async(ml_http["client"], payload)
+        ml_response.raise_for_status()
+        body = ml_response.json()
+        return body.get("results", "No result"), body.get("profile", profile)
+    except httpx.HTTPError as req_err:
+        return f"Error during prediction: {req_err}", profile
+    except ValueError:
+        return "Error decoding ML response", profile
+
+
+async def process_upload(image_obj, filename):
+    """
+    Converts the image to JPEG, checks its size, sends it to the ML client,
+    and stores the image and prediction in MongoDB.
+    Returns the inserted document's ID as a string.
+    """
+    img_data = await asyncio.to_thread(uploads.encode_jpeg, image_obj)
+
+    if len(img_data) > MAX_IMAGE_SIZE:
+        await flash("Uploaded image exceeds 16MB and cannot be stored!")
+        return None
+
+    image_hash = await asyncio.to_thread(near_duplicates.dhash, image_obj)
+    original = recent_images.lookup(image_hash)
+    if original is not None:
+        prediction, profile = original["prediction"], original["profile"]
+        duplicate_of = original["image_id"]
+    else:
+        # Fall back to the fast analysis profile while the ML clients are overloaded.
+        payload = uploads.prediction_payload(img_data, ml_clients.choose_profile())
+        (prediction, profile), duplicate_of = await request_prediction(payload), None
+
+    print(prediction, flush=True)
+
+    result = await images_collection.insert_one(
+        uploads.image_document(filename, img_data, prediction, profile, duplicate_of)
+    )
+    if duplicate_of is None:
+        recent_images.remember(image_hash, str(result.inserted_id), prediction, profile)
+    return str(result.inserted_id)
+
+
+@app.route("/", methods=["GET", "POST"])
+async def index():
+    """
+    Handles image upload and displays uploaded images.
+    For POST requests: processes the image and stores it with its prediction in MongoDB.
+    On a GET request, retrieves and renders the newly uploaded image if requested.
+    """
+    if request.method == "POST":
+        image_obj, filename = await load_image_from_request()
+        if image_obj is None:
+            return redirect(request.url)
+        new_id = await process_upload(image_obj, filename)
+        if new_id is None:
+            return redirect(request.url)
+
+        await flash("Image uploaded and processed successfully!")
+        return redirect(url_for("index", uploaded=new_id))
+
+    uploaded_id = request.args.get("uploaded")
+    files = []
+    if uploaded_id:
+        try:
+            file_doc = await find_image(uploaded_id)
+            files = (
+                [uploads.expand_prediction(file_doc)] if file_doc is not None else []
+            )
+        except (InvalidId, PyMongoError) as err:
+            await flash(f"Error retrieving image: {err}")
+
+    return await render_template("index.html", files=files)
+
+
+@app.route("/uploads/<image_id>")
+async def get_image(image_id):
+    """
+    Retrieves an image from the MongoDB collection by its document ID
+    and returns it as a file.
+    """
+    try:
+        image_doc = await find_image(image_id)
+    except (InvalidId, PyMongoError) as err:
+        await flash(f"Error retrieving image: {err}")
+        return redirect(url_for("index"))
+
+    if image_doc is None:
+        await flash("Image not found!")
+        return redirect(url_for("index"))
+
+    expires_at = retention.image_expiry(image_doc)
+    response = await send_file(
+        io.BytesIO(image_doc["data"]),
+        mimetype=image_doc.get("content_type", "image/jpeg"),
+        as_attachment=False,
+        attachment_filename=image_doc.get("filename", "image.jpg"),
+    )
+    cache.immutable_headers(
+        response, image_id, image_doc.get("upload_date"), expires_at
+    )
+    return await response.make_conditional(request)
@@ -0,0 +1,397 @@
+"""
+Client-side load balancing across ML client replicas.
+ML_CLIENT_URL may list several comma-separated base URLs; each hostname is also
+resolved to all of its addresses, so `docker-compose --scale machine-learning-client=N`
+is picked up through Docker's DNS. Requests go to the endpoint with the fewest
+outstanding requests; endpoints failing readiness checks or repeatedly erroring
+are ejected for a while, and slow requests can be hedged to a second replica.
+
+A hedged request is analyzed by both replicas, and each stores its own analysis
+record on the ML side; only the first answer is used. Keep
+ML_HEDGE_AFTER_MS well above the usual analysis time so hedges stay rare, and
+rely on the ML client's retention settings to sweep the extra records.
+"""
+
+import asyncio
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+import requests
+
+ML_HEALTH_INTERVAL_SECONDS = float(os.getenv("ML_HEALTH_INTERVAL_SECONDS", "5"))
+ML_EJECT_AFTER_FAILURES = int(os.getenv("ML_EJECT_AFTER_FAILURES", "3"))
+ML_EJECT_SECONDS = float(os.getenv("ML_EJECT_SECONDS", "30"))
+# Send a duplicate request to another replica once this much time passes (0 disables).
+ML_HEDGE_AFTER_MS = float(os.getenv("ML_HEDGE_AFTER_MS", "0"))
+# Upper bound on hedge requests in flight at once, so hedging cannot multiply load.
+ML_HEDGE_MAX_IN_FLIGHT = int(os.getenv("ML_HEDGE_MAX_IN_FLIGHT", "4"))
+READINESS_PATH = "/ready"
+# Ask for the "fast" analysis profile once the least loaded replica's smoothed
+# latency or outstanding request count reaches these thresholds (0 disables).
+ML_FAST_LATENCY_MS = float(os.getenv("ML_FAST_LATENCY_MS", "0"))
+ML_FAST_QUEUE_DEPTH = int(os.getenv("ML_FAST_QUEUE_DEPTH", "0"))
+# Latency only counts full-profile requests, so while on the fast profile send
+# one full request this often to find out whether the replicas have recovered.
+ML_FAST_PROBE_SECONDS = float(os.getenv("ML_FAST_PROBE_SECONDS", "5"))
+
+
+class Endpoint:
+    """One ML client replica and the load balancer's view of it."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        # Smoothed latency of full-profile requests only; fast ones would hide overload.
+        self.latency_ewma = None
+
+    def available(self, now):
+        """Whether the endpoint may receive traffic."""
+        return self.healthy and now >= self.ejected_until
+
+    def __repr__(self):
+        return f"Endpoint({self.url!r}, outstanding={self.outstanding})"
+
+
+def resolve_urls(url):
+    """
+    Expands a base URL into one URL per address its hostname resolves to.
+    Returns [url] unchanged when the name cannot be resolved.
+    """
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port
+    if host is None:
+        return [url]
+    try:
+        infos = socket.getaddrinfo(host, port or 80, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        return [url]
+    addresses = sorted({info[4][0] for info in infos})
+    # Prefer IPv4 so "localhost" does not also yield an unused ::1 endpoint.
+    ipv4 = [address for address in addresses if ":" not in address]
+    addresses = ipv4 or addresses
+    if len(addresses) <= 1:
+        return [url]
+    urls = []
+    for address in addresses:
+        netloc = f"[{address}]" if ":" in address else address
+        if port is not None:
+            netloc = f"{netloc}:{port}"
+        urls.append(urlunsplit(parts._replace(netloc=netloc)))
+    return urls
+
+
+class MLPool:  # pylint: disable=too-many-instance-attributes
+    """Least-outstanding-requests balancer over the configured ML client replicas."""
+
+    def __init__(
+        self,
+        urls,
+        hedge_after_ms=ML_HEDGE_AFTER_MS,
+        eject_after_failures=ML_EJECT_AFTER_FAILURES,
+        eject_seconds=ML_EJECT_SECONDS,
+    ):
+        self.urls = [url.strip() for url in urls if url and url.strip()]
+        self.hedge_after = hedge_after_ms / 1000
+        self.eject_after_failures = eject_after_failures
+        self.eject_seconds = eject_seconds
+        self.endpoints = {}
+        # Hedges take a slot without waiting for one, so a full cap skips the hedge.
+        self.hedge_slots = threading.BoundedSemaphore(max(1, ML_HEDGE_MAX_IN_FLIGHT))
+        self.fast_probe_seconds = ML_FAST_PROBE_SECONDS
+        self._full_sampled_at = time.monotonic()
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self.refresh()
+
+    @classmethod
+    def from_env(cls, value):
+        """Builds a pool from a comma-separated list of URLs."""
+        return cls((value or "").split(","))
+
+    def refresh(self):
+        """Re-resolves the configured URLs, keeping state for known endpoints."""
+        resolved = [url for base in self.urls for url in resolve_urls(base)]
+        with self._lock:
+            self.endpoints = {
+                url: self.endpoints.get(url) or Endpoint(url) for url in resolved
+            }
+
+    def check_health(self):
+        """Probes every endpoint's readiness route and records the outcome."""
+        for endpoint in list(self.endpoints.values()):
+            try:
+                response = requests.get(
+                    endpoint.url.rstrip("/") + READINESS_PATH, timeout=2
+                )
+                endpoint.healthy = response.status_code == 200
+            except requests.RequestException:
+                endpoint.healthy = False
+
+    def start_health_checks(self, interval=ML_HEALTH_INTERVAL_SECONDS):
+        """
+        Starts a daemon thread re-resolving and probing endpoints every interval seconds.
+        Returns the threading.Event that stops it, or None when disabled.
+        """
+        if interval <= 0 or not self.urls:
+            return None
+
+        stop_event = threading.Event()
+
+        def worker():
+            while not stop_event.wait(interval):
+                self.refresh()
+                self.check_health()
+
+        threading.Thread(target=worker, name="ml-health", daemon=True).start()
+        return stop_event
+
+    def acquire(self, exclude=()):
+        """
+        Picks the available endpoint with the fewest outstanding requests and
+        counts a new request against it. When every endpoint is unavailable all
+        of them are considered, so traffic still flows while checks recover.
+        Returns None when there is no endpoint outside exclude.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints.values() if e not in exclude]
+            available = [e for e in candidates if e.available(now)]
+            pool = available or candidates
+            if not pool:
+                return None
+            fewest = min(e.outstanding for e in pool)
+            endpoint = random.choice([e for e in pool if e.outstanding == fewest])
+            endpoint.outstanding += 1
+            return endpoint
+
+    def choose_profile(
+        self, latency_ms=ML_FAST_LATENCY_MS, queue_depth=ML_FAST_QUEUE_DEPTH
+    ):
+        """
+        Returns "fast" when even the least loaded available replica is over the
+        latency or queue depth threshold, and "full" otherwise. While latency
+        keeps the pool on "fast", a "full" probe is still returned every
+        fast_probe_seconds so the full-profile latency gets fresh samples.
+        """
+        now = time.monotonic()
+        with self._lock:
+            endpoints = [e for e in self.endpoints.values() if e.available(now)]
+            endpoints = endpoints or list(self.endpoints.values())
+            if not endpoints:
+                return "full"
+            fewest = min(e.outstanding for e in endpoints)
+            latencies = [
+                e.latency_ewma for e in endpoints if e.latency_ewma is not None
+            ]
+        if 0 < queue_depth <= fewest:
+            return "fast"
+        if latency_ms > 0 and latencies and min(latencies) * 1000 >= latency_ms:
+            with self._lock:
+                if now - self._full_sampled_at < self.fast_probe_seconds:
+                    return "fast"
+                self._full_sampled_at = now
+        return "full"
+
+    def release(self, endpoint, latency=None, failed=False):
+        """Records the outcome of a request started with acquire()."""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.eject_after_failures:
+                    endpoint.ejected_until = time.monotonic() + self.eject_seconds
+                    endpoint.consecutive_failures = 0
+                return
+            endpoint.consecutive_failures = 0
+            if latency is not None:
+                self._full_sampled_at = time.monotonic()
+                previous = endpoint.latency_ewma
+                endpoint.latency_ewma = (
+                    latency if previous is None else 0.8 * previous + 0.2 * latency
+                )
+
+    def attempts(self, limit=2):
+        """
+        Yields up to limit distinct endpoints for one request, each already
+        acquired; every endpoint taken from it must be passed to release().
+        """
+        tried = set()
+        for _ in range(limit):
+            endpoint = self.acquire(exclude=tried)
+            if endpoint is None:
+                return
+            tried.add(endpoint)
+            yield endpoint
+
+    def _take_hedge_slot(self):
+        # Released by the hedge itself once it finishes, not by a with block.
+        return self.hedge_slots.acquire(  # pylint: disable=consider-using-with
+            blocking=False
+        )
+
+    def _hedging(self):
+        return self.hedge_after > 0 and len(self.endpoints) > 1
+
+    def _send(self, endpoint, payload, timeout):
+        """POSTs to one endpoint; server errors count as endpoint failures."""
+        start = time.monotonic()
+        try:
+            response = requests.post(endpoint.url, json=payload, timeout=timeout)
+            if response.status_code >= 500:
+                response.raise_for_status()
+        except requests.RequestException:
+            self.release(endpoint, failed=True)
+            raise
+        latency = time.monotonic() - start
+        self.release(
+            endpoint, latency=None if payload.get("profile") == "fast" else latency
+        )
+        return response
+
+    def _start(self, endpoint, payload, timeout, hedge=False):
+        """
+        Sends on a thread of its own rather than a pooled worker, so the request
+        goes out immediately. Returns a Future for the response.
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self._send(endpoint, payload, timeout))
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                future.set_exception(err)
+            finally:
+                if hedge:
+                    self.hedge_slots.release()
+
+        threading.Thread(target=run, name="ml-post", daemon=True).start()
+        return future
+
+    def post(self, payload, timeout=30):
+        """
+        Sends the payload to the least loaded replica, retrying once on another
+        replica after a connection or server error, and hedging to a second
+        replica when the first has not answered within ML_HEDGE_AFTER_MS.
+        Returns the first successful requests.Response.
+        """
+        attempts = self.attempts()
+        if self._hedging():
+            return self._post_hedged(attempts, payload, timeout)
+        error = None
+        for endpoint in attempts:
+            try:
+                return self._send(endpoint, payload, timeout)
+            except requests.RequestException as err:
+                error = err
+        raise error or requests.ConnectionError("No ML client endpoints configured")
+
+    def _post_hedged(self, attempts, payload, timeout):
+        """
+        The hedge timer starts once the first request is sent, and a hedge is
+        only sent while a hedge slot is free. A failed first
+        attempt that was not hedged is retried on the caller's thread.
+        """
+        first = next(attempts, None)
+        if first is None:
+            raise requests.ConnectionError("No ML client endpoints configured")
+        done, pending = wait(
+            {self._start(first, payload, timeout)}, timeout=self.hedge_after
+        )
+        error, hedged = None, False
+        while True:
+            for future in done:
+                try:
+                    return future.result()
+                except requests.RequestException as err:
+                    error = err
+            if not pending:
+                retry = next(attempts, None)
+                if retry is None:
+                    raise error
+                return self._send(retry, payload, timeout)
+            if not hedged and self._take_hedge_slot():
+                hedged = True
+                second = next(attempts, None)
+                if second is None:
+                    self.hedge_slots.release()
+                else:
+                    pending.add(self._start(second, payload, timeout, hedge=True))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    async def _send_async(self, client, endpoint, payload):
+        """Async counterpart of _send() over an httpx.AsyncClient."""
+        start = time.monotonic()
+        try:
+            response = await client.post(endpoint.url, json=payload)
+            if response.status_code >= 500:
+                response.raise_for_status()
+        except httpx.HTTPError:
+            self.release(endpoint, failed=True)
+            raise
+        latency = time.monotonic() - start
+        self.release(
+            endpoint, latency=None if payload.get("profile") == "fast" else latency
+        )
+        return response
+
+    def _spawn(self, coroutine, hedge=False):
+        """Runs coroutine as a task that is kept referenced until it finishes."""
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        if hedge:
+            task.add_done_callback(lambda _: self.hedge_slots.release())
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        # The attempt that lost to another may fail after post_async() returned;
+        # release() already recorded the failure, so retrieve and drop the error.
+        if not task.cancelled():
+            task.exception()
+
+    async def post_async(self, client, payload):
+        """
+        Async counterpart of post() for the ASGI app, with the same retry and
+        hedging behaviour. Returns the first successful httpx.Response.
+        """
+        attempts = self.attempts()
+        first = next(attempts, None)
+        if first is None:
+            raise httpx.ConnectError("No ML client endpoints configured")
+        done, pending = await asyncio.wait(
+            {self._spawn(self._send_async(client, first, payload))},
+            timeout=self.hedge_after if self._hedging() else None,
+        )
+        error, hedged = None, False
+        while True:
+            for task in done:
+                try:
+                    return task.result()
+                except httpx.HTTPError as err:
+                    error = err
+            if not pending:
+                retry = next(attempts, None)
+                if retry is None:
+                    raise error
+                return await self._send_async(client, retry, payload)
+            if not hedged and self._take_hedge_slot():
+                hedged = True
+                second = next(attempts, None)
+                if second is None:
+                    self.hedge_slots.release()
+                else:
+                    hedge = self._send_async(client, second, payload)
+                    pending.add(self._spawn(hedge, hedge=True))
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
@@ -0,0 +1,132 @@
+"""
+Near-duplicate detection for uploads using a perceptual difference hash (dHash).
+Webcam captures produce runs of almost identical frames whose JPEG bytes differ
+every time, so recent images are indexed by a 64-bit dHash and an upload within
+PHASH_MAX_DISTANCE bits of an indexed image reuses that image's prediction
+instead of calling the ML client again.
+
+The index is a bounded multi-index hash: each hash is split into
+PHASH_MAX_DISTANCE + 1 chunks, and by the pigeonhole principle any hash within
+that distance matches at least one chunk exactly, so a lookup only compares
+against the few entries sharing a chunk rather than the whole index.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "4"))
+# Number of recent images kept in the index (0 disables near-duplicate reuse).
+PHASH_INDEX_SIZE = int(os.getenv("PHASH_INDEX_SIZE", "512"))
+HASH_BITS = 64
+
+
+def dhash(image):
+    """
+    Computes the 64-bit difference hash of a Pillow image: the image is shrunk
+    to 9x8 greyscale pixels and each bit records whether a pixel is brighter
+    than its right-hand neighbour.
+    """
+    if image.mode in ("1", "P"):
+        image = image.convert("RGB")
+    # Shrinking before the greyscale conversion halves the cost on large frames.
+    small = image.resize((9, 8), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    small = small.convert("L")
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(first, second):
+    """Returns the number of differing bits between two hashes."""
+    return bin(first ^ second).count("1")
+
+
+class NearDuplicateIndex:
+    """A thread-safe, LRU-bounded index of recent image hashes and their values."""
+
+    def __init__(self, max_entries=PHASH_INDEX_SIZE, max_distance=PHASH_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.max_distance = max(0, min(max_distance, HASH_BITS - 1))
+        chunks = self.max_distance + 1
+        bounds = [HASH_BITS * i // chunks for i in range(chunks + 1)]
+        # (shift, mask) for each chunk of the hash.
+        self._chunks = [
+            (start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])
+        ]
+        self._tables = [{} for _ in self._chunks]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _keys(self, value):
+        return [(value >> shift) & mask for shift, mask in self._chunks]
+
+    def lookup(self, value):
+        """
+        Returns the value stored for the closest indexed hash within
+        max_distance bits of value, or None when there is none.
+        """
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            candidates = set()
+            for table, key in zip(self._tables, self._keys(value)):
+                candidates.update(table.get(key, ()))
+            matches = [
+                (hamming(candidate, value), candidate) for candidate in candidates
+            ]
+            matches = [match for match in matches if match[0] <= self.max_distance]
+            if not matches:
+                return None
+            _, closest = min(matches)
+            self._entries.move_to_end(closest)
+            return self._entries[closest]
+
+    def add(self, value, stored):
+        """Indexes stored under the hash value, evicting the least recently used."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if value in self._entries:
+                self._entries[value] = stored
+                self._entries.move_to_end(value)
+                return
+            self._entries[value] = stored
+            for table, key in zip(self._tables, self._keys(value)):
+                table.setdefault(key, set()).add(value)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                for table, key in zip(self._tables, self._keys(evicted)):
+                    bucket = table[key]
+                    bucket.discard(evicted)
+                    if not bucket:
+                        del table[key]
+
+    def remember(self, value, image_id, prediction, profile):
+        """
+        Indexes an image's prediction unless the prediction is an error message
+        or came from the "fast" profile, whose reduced results should not
+        outlive the overload that caused them.
+        """
+        if profile != "fast" and isinstance(prediction, (dict, list)):
+            self.add(
+                value,
+                {"image_id": image_id, "prediction": prediction, "profile": profile},
+            )
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._entries.clear()
+            for table in self._tables:
+                table.clear()
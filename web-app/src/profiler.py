@@ -0,0 +1,281 @@
+"""
+Opt-in profiling hooks for the web app.
+A sampling profiler can be attached to a single request (X-Profile header) or
+run across all threads for N seconds (POST /admin/profile); samples are written
+as collapsed stacks (flamegraph.pl / speedscope) or speedscope JSON.
+tracemalloc snapshots can be taken around memory-hungry functions.
+Nothing is installed unless PROFILING_ENABLED / TRACEMALLOC_ENABLED is set.
+"""
+
+import functools
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+from flask import g, jsonify, request
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+TRACEMALLOC_ENABLED = os.getenv("TRACEMALLOC_ENABLED", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+TRACEMALLOC_SNAPSHOT_EVERY = int(os.getenv("TRACEMALLOC_SNAPSHOT_EVERY", "50"))
+
+
+def _log(message):
+    """Reports an operational message on stdout, like the rest of the web app."""
+    print(message, flush=True)
+
+
+# Everything below is identical in both services' copies of this module.
+
+PROFILE_MAX_SECONDS = 300
+PROFILE_HEADER = "X-Profile"
+TOKEN_HEADER = "X-Profile-Token"
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the Python stacks of one thread (or all threads)
+    and counts identical stacks.
+    """
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.started_at = None
+        self.duration = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a background thread."""
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(
+            target=self._run, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread to finish."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            # pylint: disable=protected-access
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if self.thread_id is not None and thread_id != self.thread_id:
+                    continue
+                self.samples[self._stack(frame)] += 1
+
+    @staticmethod
+    def _stack(frame):
+        """Return the stack as a root-first tuple of (function, file, line)."""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def collapsed(self):
+        """Return the samples in collapsed-stack format, one stack per line."""
+        lines = []
+        for stack, count in self.samples.most_common():
+            names = ";".join(
+                f"{name} ({os.path.basename(path)}:{line})"
+                for name, path, line in stack
+            )
+            lines.append(f"{names} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name):
+        """Return the samples as a speedscope 'sampled' profile document."""
+        frame_index, frames, samples, weights = {}, [], [], []
+        for stack, count in self.samples.items():
+            indexes = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    frames.append(
+                        {"name": frame[0], "file": frame[1], "line": frame[2]}
+                    )
+                indexes.append(frame_index[frame])
+            samples.append(indexes)
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": self.duration,
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+        }
+
+    def write(self, name, output_format="collapsed"):
+        """Write the profile to PROFILE_DIR and return the file path."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        stem = os.path.join(PROFILE_DIR, f"{name}-{stamp}")
+        if output_format == "speedscope":
+            path = f"{stem}.speedscope.json"
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.speedscope(name), f)
+        else:
+            path = f"{stem}.folded"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.collapsed())
+        return path
+
+
+_session = {"profiler": None}
+_session_lock = threading.Lock()
+
+
+def _authorized():
+    """Check the shared token that must accompany profiling requests."""
+    if not PROFILE_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get(TOKEN_HEADER, ""), PROFILE_TOKEN)
+
+
+def _start_request_profile():
+    if request.headers.get(PROFILE_HEADER) and _authorized():
+        g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+
+def _stop_request_profile():
+    """Stops the current request's profiler, if any, and returns the written path."""
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return None
+    profiler.stop()
+    output_format = request.headers.get(PROFILE_HEADER)
+    return profiler.write(request.endpoint or "request", output_format)
+
+
+def _finish_request_profile(response):
+    path = _stop_request_profile()
+    if path is not None:
+        # Only the file name, so server paths are not disclosed to clients.
+        response.headers["X-Profile-File"] = os.path.basename(path)
+    return response
+
+
+def _teardown_request_profile(_error):
+    # after_request hooks are skipped when a view's exception propagates, so the
+    # sampler is also stopped here to never outlive its request.
+    _stop_request_profile()
+
+
+def _profile_for(profiler, seconds, output_format):
+    """Let the profiler sample for the given number of seconds, then write it out."""
+    time.sleep(seconds)
+    profiler.stop()
+    path = profiler.write("session", output_format)
+    _log(f"Profile written to {path}")
+    with _session_lock:
+        _session["profiler"] = None
+
+
+def admin_profile():
+    """
+    Starts an all-thread profiling session for ?seconds=N (default 10).
+    Returns 202 when started, 409 if a session is already running.
+    """
+    if not _authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+    except ValueError:
+        return jsonify({"error": "seconds must be a number"}), 400
+    seconds = max(0.0, min(seconds, PROFILE_MAX_SECONDS))
+    output_format = request.args.get("format", "collapsed")
+
+    with _session_lock:
+        if _session["profiler"] is not None:
+            return jsonify({"error": "Profiling session already running"}), 409
+        profiler = _session["profiler"] = SamplingProfiler().start()
+    threading.Thread(
+        target=_profile_for, args=(profiler, seconds, output_format), daemon=True
+    ).start()
+    return jsonify({"seconds": seconds, "directory": PROFILE_DIR}), 202
+
+
+def install(app):
+    """
+    Registers the per-request profiling hooks and the admin endpoint on app.
+    Does nothing unless PROFILING_ENABLED is set, and refuses to expose the
+    endpoints without a PROFILE_TOKEN to authenticate them.
+    """
+    if not PROFILING_ENABLED:
+        return
+    if not PROFILE_TOKEN:
+        _log("Profiling is disabled: set PROFILE_TOKEN to enable it")
+        return
+    app.before_request(_start_request_profile)
+    app.after_request(_finish_request_profile)
+    app.teardown_request(_teardown_request_profile)
+    app.add_url_rule("/admin/profile", view_func=admin_profile, methods=["POST"])
+
+
+def track_memory(func):
+    """
+    Decorator recording tracemalloc growth across calls to func.
+    Every TRACEMALLOC_SNAPSHOT_EVERY calls a snapshot is dumped to PROFILE_DIR
+    and the largest allocation increases since the previous one are reported.
+    Returns func unchanged when TRACEMALLOC_ENABLED is not set.
+    """
+    if not TRACEMALLOC_ENABLED:
+        return func
+
+    state = {"calls": 0, "snapshot": None}
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            return func(*args, **kwargs)
+        finally:
+            growth = tracemalloc.get_traced_memory()[0] - before
+            state["calls"] += 1
+            _log(f"{func.__name__}: traced memory {growth:+d} bytes")
+            if state["calls"] % TRACEMALLOC_SNAPSHOT_EVERY == 0:
+                _record_snapshot(func.__name__, state)
+
+    return wrapper
+
+
+def _record_snapshot(name, state):
+    """Dump a tracemalloc snapshot and report its top differences to the last one."""
+    snapshot = tracemalloc.take_snapshot()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    snapshot.dump(os.path.join(PROFILE_DIR, f"{name}-{state['calls']}.tracemalloc"))
+    if state["snapshot"] is not None:
+        for stat in snapshot.compare_to(state["snapshot"], "lineno")[:10]:
+            _log(f"{name}: {stat}")
+    state["snapshot"] = snapshot
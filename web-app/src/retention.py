@@ -0,0 +1,148 @@
+"""
+Retention policies for the web app's images collection.
+Expires old uploads with a TTL index on upload_date and periodically
+compacts aging originals down to small JPEG thumbnails.
+"""
+
+import io
+import os
+import threading
+from datetime import datetime, timedelta
+
+from PIL import Image, UnidentifiedImageError
+from pymongo.errors import OperationFailure, PyMongoError
+
+import cache
+
+# All policies are disabled (0) unless configured through the environment.
+IMAGE_TTL_DAYS = int(os.getenv("IMAGE_TTL_DAYS", "0"))
+COMPACT_AFTER_DAYS = int(os.getenv("COMPACT_AFTER_DAYS", "0"))
+THUMBNAIL_MAX_SIDE = int(os.getenv("THUMBNAIL_MAX_SIDE", "320"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+COMPACT_BATCH_SIZE = int(os.getenv("COMPACT_BATCH_SIZE", "100"))
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "0"))
+
+
+def ensure_ttl_index(collection, field, days):
+    """
+    Creates (or updates) a TTL index that expires documents `days` after `field`.
+    Returns the index name, or None when the policy is disabled or MongoDB
+    could not be reached, so an unavailable database does not stop startup.
+    """
+    if days <= 0:
+        return None
+
+    seconds = days * 24 * 60 * 60
+    name = f"{field}_ttl"
+    try:
+        try:
+            return collection.create_index(field, name=name, expireAfterSeconds=seconds)
+        except OperationFailure:
+            # The index already exists with a different expiry; adjust it in place.
+            collection.database.command(
+                "collMod",
+                collection.name,
+                index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds},
+            )
+            return name
+    except PyMongoError as err:
+        print(f"Could not create TTL index {name}: {err}", flush=True)
+        return None
+
+
+def image_expiry(image_doc):
+    """Returns when an image document expires under IMAGE_TTL_DAYS, or None."""
+    return cache.document_expiry(image_doc, "upload_date", IMAGE_TTL_DAYS)
+
+
+def make_thumbnail(data, max_side=THUMBNAIL_MAX_SIDE, quality=THUMBNAIL_QUALITY):
+    """
+    Re-encodes the given image bytes as a JPEG no larger than max_side on either edge.
+    Returns the thumbnail bytes, or None if the data is not a readable image.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Let the JPEG decoder shrink while loading instead of decoding full size.
+        image.draft("RGB", (max_side, max_side))
+        image.thumbnail((max_side, max_side))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        thumb_bytes = io.BytesIO()
+        image.save(thumb_bytes, format="JPEG", quality=quality, optimize=True)
+    except (UnidentifiedImageError, OSError):
+        return None
+    return thumb_bytes.getvalue()
+
+
+def compact_images(  # pylint: disable=too-many-arguments
+    collection,
+    older_than_days=COMPACT_AFTER_DAYS,
+    max_side=THUMBNAIL_MAX_SIDE,
+    quality=THUMBNAIL_QUALITY,
+    batch_size=COMPACT_BATCH_SIZE,
+    *,
+    on_compacted=None,
+):
+    """
+    Replaces the stored data of images older than `older_than_days` with a thumbnail,
+    calling on_compacted(image_id) for each rewritten image (e.g. to drop caches).
+    Returns a report dict with the number of compacted images and bytes reclaimed.
+    """
+    report = {"images_compacted": 0, "bytes_reclaimed": 0}
+    if older_than_days <= 0:
+        return report
+
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    cursor = collection.find(
+        {"upload_date": {"$lt": cutoff}, "compacted": {"$ne": True}},
+        {"data": 1},
+    ).limit(batch_size)
+
+    for doc in cursor:
+        original = doc.get("data") or b""
+        thumbnail = make_thumbnail(original, max_side, quality)
+        update = {"compacted": True, "original_size": len(original)}
+        if thumbnail is not None and len(thumbnail) < len(original):
+            update["data"] = thumbnail
+            update["content_type"] = "image/jpeg"
+            report["bytes_reclaimed"] += len(original) - len(thumbnail)
+            report["images_compacted"] += 1
+        collection.update_one({"_id": doc["_id"]}, {"$set": update})
+        if "data" in update and on_compacted is not None:
+            on_compacted(doc["_id"])
+
+    return report
+
+
+def run_retention(collection, on_compacted=None):
+    """
+    Runs one retention pass over the images collection and prints its report.
+    """
+    try:
+        report = compact_images(collection, on_compacted=on_compacted)
+    except PyMongoError as err:
+        print(f"Retention run failed: {err}", flush=True)
+        return None
+    print(f"Retention run: {report}", flush=True)
+    return report
+
+
+def start_retention_worker(
+    collection, interval=RETENTION_INTERVAL_SECONDS, on_compacted=None
+):
+    """
+    Starts a daemon thread that runs the retention pass every `interval` seconds.
+    on_compacted is passed on to compact_images().
+    Returns the threading.Event that stops the worker, or None when disabled.
+    """
+    if interval <= 0:
+        return None
+
+    stop_event = threading.Event()
+
+    def worker():
+        while not stop_event.wait(interval):
+            run_retention(collection, on_compacted)
+
+    threading.Thread(target=worker, name="retention", daemon=True).start()
+    return stop_event
@@ -0,0 +1,56 @@
+"""
+Helpers shared by the WSGI (app.py) and ASGI (asgi_app.py) web apps for
+preparing uploaded images and the documents stored for them.
+"""
+
+import io
+import base64
+from datetime import datetime
+
+import compact_results
+
+
+def encode_jpeg(image_obj):
+    """Re-encodes the image as JPEG bytes, dropping any alpha channel."""
+    if image_obj.mode in ("RGBA", "LA"):
+        image_obj = image_obj.convert("RGB")
+    image_bytes = io.BytesIO()
+    image_obj.save(image_bytes, format="JPEG")
+    return image_bytes.getvalue()
+
+
+def prediction_payload(img_data, profile):
+    """Builds the ML client request body for a JPEG analyzed with the named profile."""
+    image_b64 = base64.b64encode(img_data).decode("utf-8")
+    # Ask for the compact results format; it is expanded again only for display.
+    return {
+        "image": f"data:image/jpeg;base64,{image_b64}",
+        "format": "compact",
+        "profile": profile,
+    }
+
+
+def image_document(filename, img_data, prediction, profile, duplicate_of=None):
+    """
+    Builds the images collection document for an uploaded JPEG.
+    profile names the ML analysis profile that produced the prediction, and
+    duplicate_of is the ID of the near-identical image whose prediction was reused.
+    """
+    document = {
+        "filename": filename,
+        "data": img_data,
+        "content_type": "image/jpeg",
+        "upload_date": datetime.utcnow(),
+        "prediction": prediction,
+        "profile": profile,
+    }
+    if duplicate_of is not None:
+        document["duplicate_of"] = duplicate_of
+    return document
+
+
+def expand_prediction(image_doc):
+    """Returns a copy of the image document with its prediction in the legacy form."""
+    return dict(
+        image_doc, prediction=compact_results.expand(image_doc.get("prediction"))
+    )
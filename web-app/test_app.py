@@ -2,17 +2,45 @@
 Test module for src.app endpoints and functionality.
 """
 
+# pylint: disable=too-many-lines
+
 import io
 import os
+import sys
+import time
+import json
+import asyncio
+import gc
+import hashlib
+import importlib.util
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+import bson
+import httpx
 import pytest
+from flask import Flask, request
 from PIL import Image
 from bson.objectid import ObjectId
+from pymongo.errors import ServerSelectionTimeoutError
 from requests import RequestException
+from werkzeug.datastructures import FileStorage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "src"))
+# pylint: disable=wrong-import-position
 from src.app import (
     load_image_from_request,
     process_upload,
     app,
 )
+import asgi_app
+import ml_pool
+import near_duplicates
+import cache
+import capture
+import compact_results
+import profiler
+import retention
 
 os.environ.setdefault("SECRET_KEY", "test_secret_key")
 os.environ.setdefault("MONGO_DBNAME", "test_db")
@@ -60,6 +88,9 @@ def fake_images_collection(monkeypatch):
     """Fixture to override the images_collection with a fake collection."""
     fake_collection = FakeImagesCollection()
     monkeypatch.setattr("src.app.images_collection", fake_collection)
+    monkeypatch.setattr("src.app.document_cache", cache.ReadThroughCache(directory=""))
+    monkeypatch.setattr("src.app.recent_images", near_duplicates.NearDuplicateIndex())
+    monkeypatch.setattr(asgi_app, "recent_images", near_duplicates.NearDuplicateIndex())
     return fake_collection
 
 
@@ -246,3 +277,880 @@ def test_get_image_invalid_objectid(monkeypatch):
             b"Error retrieving image" in response.data
             or b"Image not found" in response.data
         )
+
+
+def make_jpeg_bytes(size, color="green"):
+    """Return the JPEG encoding of a solid-colour image of the given size."""
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color=color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class FakeRetentionCollection:
+    """A fake collection supporting the queries issued by the retention compactor."""
+
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: doc for doc in docs}
+
+    def find(self, query, _projection=None):
+        """Return the uncompacted documents uploaded before the cutoff."""
+        cutoff = query["upload_date"]["$lt"]
+        matches = [
+            doc
+            for doc in self.docs.values()
+            if doc["upload_date"] < cutoff and not doc.get("compacted")
+        ]
+
+        # pylint: disable=too-few-public-methods
+        class Cursor(list):
+            """A list that accepts the cursor limit() call."""
+
+            def limit(self, count):
+                """Truncate the results to count documents."""
+                return Cursor(self[:count])
+
+        return Cursor(matches)
+
+    def update_one(self, query, update):
+        """Apply a $set update to the matching document."""
+        self.docs[query["_id"]].update(update["$set"])
+
+
+def test_ensure_ttl_index_disabled():
+    """Test that no index is created when the TTL is not configured."""
+    assert retention.ensure_ttl_index(None, "upload_date", 0) is None
+
+
+def test_ensure_ttl_index_unreachable_database():
+    """Test that an unreachable database does not stop the app from starting."""
+
+    class UnreachableCollection:
+        """A collection whose server cannot be selected."""
+
+        def create_index(self, *args, **kwargs):
+            """Fail like pymongo does when MongoDB is down."""
+            raise ServerSelectionTimeoutError("down")
+
+    assert retention.ensure_ttl_index(UnreachableCollection(), "upload_date", 1) is None
+
+
+def test_make_thumbnail_invalid_data():
+    """Test that make_thumbnail returns None for bytes that are not an image."""
+    assert retention.make_thumbnail(b"not an image") is None
+
+
+def test_compact_images_reports_reclaimed_bytes():
+    """Test that old images are replaced with thumbnails and recent ones are kept."""
+    original = make_jpeg_bytes((2000, 1500))
+    now = datetime.utcnow()
+    collection = FakeRetentionCollection(
+        [
+            {"_id": "old", "data": original, "upload_date": now - timedelta(days=40)},
+            {"_id": "new", "data": original, "upload_date": now},
+        ]
+    )
+
+    compacted = []
+    report = retention.compact_images(
+        collection, older_than_days=30, max_side=64, on_compacted=compacted.append
+    )
+
+    old_doc = collection.docs["old"]
+    assert old_doc["compacted"] is True
+    assert old_doc["original_size"] == len(original)
+    assert max(Image.open(io.BytesIO(old_doc["data"])).size) <= 64
+    assert "compacted" not in collection.docs["new"]
+    assert compacted == ["old"]
+    assert report == {
+        "images_compacted": 1,
+        "bytes_reclaimed": len(original) - len(old_doc["data"]),
+    }
+
+
+def test_track_memory_disabled_returns_function(monkeypatch):
+    """Test that track_memory adds no wrapper when tracemalloc is disabled."""
+    monkeypatch.setattr(profiler, "TRACEMALLOC_ENABLED", False)
+
+    def func():
+        return 1
+
+    assert profiler.track_memory(func) is func
+
+
+def test_install_disabled_registers_nothing(monkeypatch):
+    """Test that no hooks or routes are added when profiling is disabled."""
+    monkeypatch.setattr(profiler, "PROFILING_ENABLED", False)
+    profiled_app = Flask(__name__)
+    profiler.install(profiled_app)
+    assert not profiled_app.before_request_funcs
+    assert "/admin/profile" not in [r.rule for r in profiled_app.url_map.iter_rules()]
+
+
+def test_install_without_token_registers_nothing(monkeypatch):
+    """Test that profiling endpoints are never exposed without a token."""
+    monkeypatch.setattr(profiler, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "")
+    profiled_app = Flask(__name__)
+    profiler.install(profiled_app)
+    assert not profiled_app.before_request_funcs
+    assert "/admin/profile" not in [r.rule for r in profiled_app.url_map.iter_rules()]
+
+
+def test_profile_header_writes_collapsed_stacks(monkeypatch, tmp_path):
+    """Test that a request with the X-Profile header produces a collapsed profile."""
+    monkeypatch.setattr(profiler, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    profiled_app = Flask(__name__)
+    profiler.install(profiled_app)
+
+    @profiled_app.route("/slow")
+    def slow():
+        busy_until = time.perf_counter() + 0.1
+        while time.perf_counter() < busy_until:
+            pass
+        return "done"
+
+    with profiled_app.test_client() as test_client:
+        anonymous = test_client.get("/slow", headers={"X-Profile": "1"})
+        response = test_client.get(
+            "/slow", headers={"X-Profile": "1", "X-Profile-Token": "secret"}
+        )
+
+    assert "X-Profile-File" not in anonymous.headers
+    name = response.headers["X-Profile-File"]
+    assert os.path.basename(name) == name and name.endswith(".folded")
+    path = os.path.join(tmp_path, name)
+    with open(path, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert any("slow (test_app.py" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+def test_profile_stopped_when_view_raises(monkeypatch, tmp_path):
+    """Test that a profiled request whose view raises does not leak its sampler."""
+    monkeypatch.setattr(profiler, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    profiled_app = Flask(__name__)
+    profiled_app.testing = True
+    profiler.install(profiled_app)
+
+    @profiled_app.route("/boom")
+    def boom():
+        raise RuntimeError("boom")
+
+    with profiled_app.test_client() as test_client:
+        with pytest.raises(RuntimeError):
+            test_client.get(
+                "/boom", headers={"X-Profile": "1", "X-Profile-Token": "secret"}
+            )
+
+    assert not any(
+        thread.name == "sampling-profiler" for thread in threading.enumerate()
+    )
+    assert len(os.listdir(tmp_path)) == 1
+
+
+class FakeAsyncImagesCollection:
+    """An awaitable wrapper around FakeImagesCollection for the ASGI app."""
+
+    def __init__(self):
+        self.sync = FakeImagesCollection()
+        self.data = self.sync.data
+
+    async def insert_one(self, doc):
+        """Simulate an asynchronous document insert."""
+        return self.sync.insert_one(doc)
+
+    async def find_one(self, query):
+        """Simulate an asynchronous single-document lookup."""
+        return self.sync.find_one(query)
+
+
+def run_asgi_request(method, path, **kwargs):
+    """Issue one request against the ASGI app with its serving hooks running."""
+
+    async def issue():
+        async with asgi_app.app.test_app() as test_app:
+            test_client = test_app.test_client()
+            response = await getattr(test_client, method)(path, **kwargs)
+            return response, await response.get_data()
+
+    return asyncio.run(issue())
+
+
+def test_asgi_index_get(monkeypatch):
+    """Test that the ASGI app renders the upload page."""
+    monkeypatch.setattr(asgi_app, "images_collection", FakeAsyncImagesCollection())
+    response, body = run_asgi_request("get", "/")
+    assert response.status_code == 200
+    assert b"Upload" in body
+
+
+def test_asgi_upload_stores_prediction(monkeypatch):
+    """Test that an ASGI upload posts to the ML client and stores its results."""
+    collection = FakeAsyncImagesCollection()
+    monkeypatch.setattr(asgi_app, "images_collection", collection)
+
+    async def fake_prediction(payload):
+        assert payload["image"].startswith("data:image/jpeg;base64,")
+        return [{"dominant_emotion": "happy"}], payload["profile"]
+
+    monkeypatch.setattr(asgi_app, "request_prediction", fake_prediction)
+    image = Image.new("RGBA", (10, 10), color="red")
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format="PNG")
+
+    response, _ = run_asgi_request(
+        "post",
+        "/",
+        form={"captured_image": ""},
+        files={
+            "image": FileStorage(io.BytesIO(image_bytes.getvalue()), filename="a.png")
+        },
+    )
+
+    assert response.status_code == 302
+    assert "uploaded=test_id" in response.headers["Location"]
+    assert collection.data["test_id"]["prediction"] == [{"dominant_emotion": "happy"}]
+    assert collection.data["test_id"]["content_type"] == "image/jpeg"
+    assert collection.data["test_id"]["profile"] == "full"
+
+
+def test_asgi_get_image_invalid_objectid(monkeypatch):
+    """Test that the ASGI image route redirects on an invalid id."""
+    monkeypatch.setattr(asgi_app, "images_collection", FakeAsyncImagesCollection())
+    response, _ = run_asgi_request("get", "/uploads/invalid-id")
+    assert response.status_code == 302
+
+
+class CountingImagesCollection(FakeImagesCollection):
+    """A FakeImagesCollection that counts find_one calls."""
+
+    def __init__(self):
+        super().__init__()
+        self.lookups = 0
+
+    def find_one(self, query):
+        """Count the lookup and delegate to the fake collection."""
+        self.lookups += 1
+        return super().find_one(query)
+
+
+def test_get_image_is_cached_and_conditional(monkeypatch):
+    """Test that image lookups are cached and revalidations return 304 without a query."""
+    collection = CountingImagesCollection()
+    image_id = ObjectId()
+    collection.data[image_id] = {
+        "_id": image_id,
+        "data": make_jpeg_bytes((4, 4)),
+        "content_type": "image/jpeg",
+        "filename": "a.jpg",
+        "upload_date": datetime(2025, 1, 1),
+    }
+    monkeypatch.setattr("src.app.images_collection", collection)
+
+    with app.test_client() as test_client:
+        first = test_client.get(f"/uploads/{image_id}")
+        second = test_client.get(f"/uploads/{image_id}")
+        revalidated = test_client.get(
+            f"/uploads/{image_id}", headers={"If-None-Match": first.headers["ETag"]}
+        )
+
+    assert first.status_code == second.status_code == 200
+    assert first.headers["ETag"] == f'W/"{image_id}"'
+    assert "immutable" in first.headers["Cache-Control"]
+    assert "no-cache" not in first.headers["Cache-Control"]
+    assert first.headers["Last-Modified"] == "Wed, 01 Jan 2025 00:00:00 GMT"
+    assert revalidated.status_code == 304
+    assert collection.lookups == 1
+
+
+def test_revalidation_bounded_by_ttl_and_checks_the_image(monkeypatch):
+    """Test that 304s keep the TTL-bounded max-age and unknown ids are not 304s."""
+    collection = CountingImagesCollection()
+    image_id = ObjectId()
+    collection.data[image_id] = {
+        "_id": image_id,
+        "data": make_jpeg_bytes((4, 4)),
+        "content_type": "image/jpeg",
+        "upload_date": datetime.utcnow(),
+    }
+    monkeypatch.setattr("src.app.images_collection", collection)
+    monkeypatch.setattr(retention, "IMAGE_TTL_DAYS", 1)
+
+    with app.test_client() as test_client:
+        revalidated = test_client.get(
+            f"/uploads/{image_id}", headers={"If-None-Match": f'W/"{image_id}"'}
+        )
+        unknown_id = ObjectId()
+        unknown = test_client.get(
+            f"/uploads/{unknown_id}", headers={"If-None-Match": f'W/"{unknown_id}"'}
+        )
+        invalid = test_client.get(
+            "/uploads/not-an-id", headers={"If-None-Match": 'W/"not-an-id"'}
+        )
+
+    assert revalidated.status_code == 304
+    assert 86000 < revalidated.cache_control.max_age <= 86400
+    assert unknown.status_code == invalid.status_code == 302
+
+
+def test_asgi_get_image_is_cached_and_conditional(monkeypatch):
+    """Test that the ASGI image route shares the WSGI app's caching behaviour."""
+    collection = FakeAsyncImagesCollection()
+    collection.sync = CountingImagesCollection()
+    image_id = ObjectId()
+    collection.sync.data[image_id] = {
+        "_id": image_id,
+        "data": make_jpeg_bytes((4, 4)),
+        "content_type": "image/jpeg",
+        "upload_date": datetime(2025, 1, 1),
+    }
+    monkeypatch.setattr(asgi_app, "images_collection", collection)
+    monkeypatch.setattr(
+        asgi_app, "document_cache", cache.ReadThroughCache(directory="")
+    )
+
+    first, _ = run_asgi_request("get", f"/uploads/{image_id}")
+    revalidated, body = run_asgi_request(
+        "get", f"/uploads/{image_id}", headers={"If-None-Match": first.headers["ETag"]}
+    )
+
+    assert first.status_code == 200
+    assert first.headers["ETag"] == f'W/"{image_id}"'
+    assert "immutable" in first.headers["Cache-Control"]
+    assert "no-cache" not in first.headers["Cache-Control"]
+    assert revalidated.status_code == 304 and body == b""
+    assert collection.sync.lookups == 1
+
+
+def test_read_through_cache_async_disk_tier(tmp_path):
+    """Test that async lookups fill and then reuse the disk tier."""
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        return {"data": b"abc"}
+
+    async def lookup():
+        shared = cache.ReadThroughCache(directory=str(tmp_path))
+        await shared.get_or_load_async("key", loader)
+        fresh = cache.ReadThroughCache(directory=str(tmp_path))
+        return await fresh.get_or_load_async("key", loader)
+
+    assert asyncio.run(lookup()) == {"data": b"abc"}
+    assert len(loads) == 1
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """Test that the LRU cache stays within its byte budget."""
+    lru = cache.LRUCache(max_bytes=400)
+    lru.set("a", b"x" * 100)
+    lru.set("b", b"x" * 100)
+    assert lru.get("a") is not None
+    lru.set("c", b"x" * 100)
+    assert lru.get("b") is None
+    assert lru.get("a") is not None and lru.get("c") is not None
+    assert lru.current_bytes <= 400
+
+
+def test_read_through_cache_disk_tier(tmp_path):
+    """Test that values written by one cache instance are served from disk to another."""
+    first = cache.ReadThroughCache(directory=str(tmp_path))
+    assert first.get_or_load("key", lambda: {"value": 1}) == {"value": 1}
+
+    second = cache.ReadThroughCache(directory=str(tmp_path))
+    assert second.get_or_load("key", lambda: None) == {"value": 1}
+
+
+def test_disk_tier_stores_bson(tmp_path):
+    """Test that the shared disk tier round-trips documents as BSON, not pickle."""
+    document = {"data": b"\xff\xd8", "upload_date": datetime(2025, 1, 1)}
+    cache.DiskCache(str(tmp_path)).set("key", document)
+
+    (path,) = tmp_path.iterdir()
+    assert path.suffix == ".bson"
+    assert bson.decode(path.read_bytes())["value"] == document
+    assert cache.DiskCache(str(tmp_path)).get("key") == document
+
+
+def test_cache_entries_expire_with_their_document(tmp_path):
+    """Test that cached documents are not served past their retention expiry."""
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {"value": len(loads)}
+
+    read_through = cache.ReadThroughCache(directory=str(tmp_path))
+
+    def already_expired(_doc):
+        return datetime.utcnow() - timedelta(seconds=1)
+
+    read_through.get_or_load("gone", loader, already_expired)
+    read_through.get_or_load("gone", loader, already_expired)
+    assert len(loads) == 2
+    assert not list(tmp_path.iterdir())
+
+    read_through = cache.ReadThroughCache(directory="", ttl=60)
+    read_through.get_or_load("kept", loader)
+    assert read_through.get_or_load("kept", loader) == {"value": 3}
+    read_through.invalidate("kept")
+    assert read_through.get_or_load("kept", loader) == {"value": 4}
+
+    lru = cache.LRUCache()
+    lru.set("stale", b"x", expires_at=time.time() - 1)
+    assert lru.get("stale") is None and lru.current_bytes == 0
+
+
+def test_get_image_max_age_bounded_by_ttl(monkeypatch):
+    """Test that browsers are not told to keep an image past its TTL."""
+    collection = FakeImagesCollection()
+    image_id = ObjectId()
+    collection.data[image_id] = {
+        "_id": image_id,
+        "data": make_jpeg_bytes((4, 4)),
+        "content_type": "image/jpeg",
+        "upload_date": datetime.utcnow() - timedelta(days=6),
+    }
+    monkeypatch.setattr("src.app.images_collection", collection)
+    monkeypatch.setattr(retention, "IMAGE_TTL_DAYS", 7)
+
+    with app.test_client() as test_client:
+        response = test_client.get(f"/uploads/{image_id}")
+
+    max_age = response.cache_control.max_age
+    assert 86000 < max_age <= 86400
+
+
+def test_capture_records_uploads_by_reference(monkeypatch, tmp_path):
+    """Test that captured requests store image bytes by hash, not inline."""
+    capture_path = tmp_path / "requests.jsonl"
+    blob_dir = tmp_path / "blobs"
+    monkeypatch.setattr(capture, "CAPTURE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(capture, "CAPTURE_PATH", str(capture_path))
+    monkeypatch.setattr(capture, "CAPTURE_BLOB_DIR", str(blob_dir))
+    captured_app = Flask(__name__)
+    capture.install(captured_app)
+
+    @captured_app.route("/", methods=["POST"])
+    def upload():
+        return str(len(request.files["image"].read()))
+
+    image_data = make_jpeg_bytes((8, 8))
+    with captured_app.test_client() as test_client:
+        response = test_client.post(
+            "/?x=1", data={"image": (io.BytesIO(image_data), "face.jpg")}
+        )
+
+    assert response.data == str(len(image_data)).encode()
+    record = json.loads(capture_path.read_text(encoding="utf-8"))
+    digest = hashlib.sha256(image_data).hexdigest()
+    assert record["service"] == "web-app"
+    assert record["query"] == "x=1"
+    assert record["status"] == 200
+    assert record["files"]["image"]["sha256"] == digest
+    assert record["files"]["image"]["filename"] == "face.jpg"
+    assert (blob_dir / digest).read_bytes() == image_data
+
+
+def test_capture_failure_drops_sample(monkeypatch, tmp_path):
+    """Test that an unwritable blob directory never fails the sampled request."""
+    not_a_dir = tmp_path / "blobs"
+    not_a_dir.write_text("", encoding="utf-8")
+    monkeypatch.setattr(capture, "CAPTURE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(capture, "CAPTURE_PATH", str(tmp_path / "requests.jsonl"))
+    monkeypatch.setattr(capture, "CAPTURE_BLOB_DIR", str(not_a_dir))
+    captured_app = Flask(__name__)
+    capture.install(captured_app)
+
+    @captured_app.route("/", methods=["POST"])
+    def upload():
+        return "ok"
+
+    with captured_app.test_client() as test_client:
+        response = test_client.post(
+            "/", data={"image": (io.BytesIO(make_jpeg_bytes((8, 8))), "face.jpg")}
+        )
+
+    assert response.status_code == 200
+    assert not (tmp_path / "requests.jsonl").exists()
+
+
+def test_index_renders_compact_prediction(monkeypatch):
+    """Test that a stored compact prediction is expanded for display."""
+    collection = FakeImagesCollection()
+    monkeypatch.setattr("src.app.images_collection", collection)
+    image_id = ObjectId()
+    collection.data[image_id] = {
+        "_id": image_id,
+        "filename": "a.jpg",
+        "upload_date": datetime(2025, 1, 1),
+        "prediction": {
+            "v": 1,
+            "faces": [[[0, 0, 5, 5], 27, [250, 5], [0, 0, 0, 10, 0, 240, 5]]],
+        },
+    }
+    with app.test_client() as test_client:
+        response = test_client.get(f"/?uploaded={image_id}")
+    assert response.status_code == 200
+    assert b"surprise" in response.data
+    assert b"Woman" in response.data
+    assert b"27" in response.data
+
+
+class StubMLServer:
+    """A local HTTP server standing in for one ML client replica."""
+
+    def __init__(self, status=200, delay=0.0, ready=True):
+        stub = self
+        self.hits = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers analysis and readiness requests."""
+
+            def reply(self, code, body):
+                """Send a JSON response."""
+                payload = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Answer the readiness probe."""
+                self.reply(200 if ready else 503, {})
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Answer an analysis request."""
+                self.rfile.read(int(self.headers["Content-Length"]))
+                stub.hits += 1
+                time.sleep(delay)
+                self.reply(status, {"results": stub.url})
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Silence request logging."""
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(name="stub_servers")
+def fixture_stub_servers():
+    """Start stub ML servers on demand and stop them after the test."""
+    servers = []
+
+    def start(**kwargs):
+        server = StubMLServer(**kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def test_ml_pool_least_outstanding(stub_servers):
+    """Test that concurrent requests are spread over idle replicas first."""
+    first, second = stub_servers(), stub_servers()
+    pool = ml_pool.MLPool([first.url, second.url])
+    picked = {pool.acquire().url, pool.acquire().url}
+    assert picked == {first.url, second.url}
+
+
+def test_ml_pool_retries_and_ejects_failing_replica(stub_servers):
+    """Test that server errors fail over to a healthy replica and eject the bad one."""
+    bad, good = stub_servers(status=500), stub_servers()
+    pool = ml_pool.MLPool([bad.url, good.url], eject_after_failures=1)
+    for _ in range(5):
+        assert pool.post({"image": "x"}).json()["results"] == good.url
+    assert bad.hits <= 1
+    assert pool.endpoints[bad.url].ejected_until > 0
+
+
+def test_ml_pool_hedges_slow_replica(stub_servers):
+    """Test that a slow request is hedged and the faster replica's answer wins."""
+    slow, fast = stub_servers(delay=1.0), stub_servers()
+    pool = ml_pool.MLPool([slow.url, fast.url], hedge_after_ms=50)
+    # Make the slow replica the least loaded so it receives the first attempt.
+    pool.endpoints[fast.url].outstanding = 1
+
+    start = time.perf_counter()
+    response = pool.post({"image": "x"})
+
+    assert response.json()["results"] == fast.url
+    assert time.perf_counter() - start < 0.8
+    assert slow.hits == 1
+
+
+def post_concurrently(pool, count):
+    """Send count posts from separate threads and wait for all of them."""
+    threads = [
+        threading.Thread(target=pool.post, args=({"image": "x"},)) for _ in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_ml_pool_concurrent_posts_are_not_hedged_early(stub_servers):
+    """Test that concurrent posts answered before the hedge delay send no hedges."""
+    first, second = stub_servers(delay=0.3), stub_servers(delay=0.3)
+    pool = ml_pool.MLPool([first.url, second.url], hedge_after_ms=1000)
+
+    start = time.perf_counter()
+    post_concurrently(pool, 48)
+
+    assert time.perf_counter() - start < 1.0
+    assert first.hits + second.hits == 48
+
+
+def test_ml_pool_caps_hedges_in_flight(stub_servers):
+    """Test that no more hedge requests run at once than there are hedge slots."""
+    first, second = stub_servers(delay=0.4), stub_servers(delay=0.4)
+    pool = ml_pool.MLPool([first.url, second.url], hedge_after_ms=50)
+    pool.hedge_slots = threading.BoundedSemaphore(2)
+
+    post_concurrently(pool, 8)
+
+    assert first.hits + second.hits == 10
+
+
+def test_ml_pool_post_async_hedges_slow_replica(stub_servers):
+    """Test that the ASGI app's async posts are hedged like the blocking ones."""
+    slow, fast = stub_servers(delay=1.0), stub_servers()
+    pool = ml_pool.MLPool([slow.url, fast.url], hedge_after_ms=50)
+    pool.endpoints[fast.url].outstanding = 1
+
+    async def post():
+        async with httpx.AsyncClient() as http_client:
+            start = time.perf_counter()
+            response = await pool.post_async(http_client, {"image": "x"})
+            return response, time.perf_counter() - start
+
+    response, elapsed = asyncio.run(post())
+
+    assert response.json()["results"] == fast.url
+    assert elapsed < 0.8
+    assert slow.hits == 1
+
+
+def test_ml_pool_post_async_retrieves_losing_errors(stub_servers):
+    """Test that a hedged-out attempt failing later is not reported as unretrieved."""
+    failing, fast = stub_servers(status=500, delay=0.3), stub_servers()
+    pool = ml_pool.MLPool([failing.url, fast.url], hedge_after_ms=50)
+    pool.endpoints[fast.url].outstanding = 1
+    unhandled = []
+
+    async def post():
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: unhandled.append(context)
+        )
+        async with httpx.AsyncClient() as http_client:
+            response = await pool.post_async(http_client, {"image": "x"})
+            # Let the losing attempt fail, then collect its finished task.
+            await asyncio.sleep(0.6)
+        gc.collect()
+        return response
+
+    assert asyncio.run(post()).json()["results"] == fast.url
+    assert failing.hits == 1
+    assert not unhandled
+
+
+def test_ml_pool_health_checks(stub_servers):
+    """Test that replicas failing their readiness probe stop receiving traffic."""
+    unready, ready = stub_servers(ready=False), stub_servers()
+    pool = ml_pool.MLPool([unready.url, ready.url])
+    pool.check_health()
+    assert not pool.endpoints[unready.url].healthy
+    assert all(pool.acquire().url == ready.url for _ in range(4))
+
+
+def gradient_image(size=(64, 48), flip=False):
+    """Builds a horizontal greyscale-gradient RGB test image."""
+    image = Image.linear_gradient("L").transpose(Image.Transpose.ROTATE_90)
+    image = image.resize(size).convert("RGB")
+    return image.transpose(Image.Transpose.FLIP_LEFT_RIGHT) if flip else image
+
+
+def test_dhash_tolerates_jpeg_reencoding():
+    """Test that re-encoded copies hash close together and different images do not."""
+    image = Image.radial_gradient("L").resize((120, 90)).convert("RGB")
+    copies = []
+    for quality in (95, 40):
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        copies.append(near_duplicates.dhash(Image.open(buffer)))
+    assert (
+        near_duplicates.hamming(copies[0], copies[1])
+        <= near_duplicates.PHASH_MAX_DISTANCE
+    )
+    flipped = near_duplicates.dhash(gradient_image(flip=True))
+    assert near_duplicates.hamming(near_duplicates.dhash(gradient_image()), flipped) > 8
+
+
+def test_near_duplicate_index_lookup_and_eviction():
+    """Test matching within the distance threshold and LRU eviction."""
+    index = near_duplicates.NearDuplicateIndex(max_entries=2, max_distance=3)
+    index.add(0xFFFF_0000_FFFF_0000, "a")
+    index.add(0x0F0F_0F0F_0F0F_0F0F, "b")
+
+    assert index.lookup(0xFFFF_0000_FFFF_0007) == "a"
+    assert index.lookup(0xFFFF_0000_FFFF_000F) is None
+
+    # "a" was just used, so adding a third hash evicts "b".
+    index.add(0x1234_5678_9ABC_DEF0, "c")
+    assert len(index) == 2
+    assert index.lookup(0x0F0F_0F0F_0F0F_0F0F) is None
+    assert index.lookup(0xFFFF_0000_FFFF_0000) == "a"
+
+
+def test_process_upload_reuses_near_duplicate_prediction(monkeypatch):
+    """Test that a near-identical upload reuses the earlier prediction."""
+    calls = []
+
+    def fake_prediction(img_data):
+        calls.append(img_data)
+        return {"v": 1, "faces": []}, "full"
+
+    inserted = []
+    collection = FakeImagesCollection()
+    store = collection.insert_one
+
+    def record_insert(doc):
+        inserted.append(doc)
+        return store(doc)
+
+    monkeypatch.setattr(collection, "insert_one", record_insert)
+    monkeypatch.setattr("src.app.images_collection", collection)
+    monkeypatch.setattr("src.app.request_prediction", fake_prediction)
+    frame = gradient_image()
+    with app.test_request_context("/"):
+        process_upload(frame, "first.jpg")
+        process_upload(frame.resize((66, 50)), "second.jpg")
+        process_upload(gradient_image(flip=True), "third.jpg")
+
+    assert len(calls) == 2
+    assert inserted[1]["prediction"] == inserted[0]["prediction"]
+    assert inserted[1]["duplicate_of"] == "test_id"
+    assert inserted[1]["profile"] == "full"
+    assert "duplicate_of" not in inserted[2]
+
+
+def test_process_upload_does_not_reuse_fast_prediction(monkeypatch):
+    """Test that predictions made under the fast profile are not reused."""
+    profiles = ["fast", "full", "full"]
+
+    def fake_prediction(img_data):
+        return {"v": 1, "faces": []}, profiles.pop(0)
+
+    monkeypatch.setattr("src.app.request_prediction", fake_prediction)
+    frame = gradient_image()
+    with app.test_request_context("/"):
+        process_upload(frame, "first.jpg")
+        process_upload(frame, "second.jpg")
+        process_upload(frame, "third.jpg")
+
+    assert profiles == ["full"]
+
+
+def test_ml_pool_falls_back_to_fast_profile():
+    """Test that the fast profile is chosen once latency or queue depth is too high."""
+    pool = ml_pool.MLPool(["http://127.0.0.1:9"])
+    endpoint = pool.endpoints["http://127.0.0.1:9"]
+    assert pool.choose_profile(latency_ms=1000, queue_depth=4) == "full"
+
+    endpoint.latency_ewma = 1.5
+    assert pool.choose_profile(latency_ms=1000, queue_depth=4) == "fast"
+    assert pool.choose_profile(latency_ms=0, queue_depth=4) == "full"
+
+    endpoint.latency_ewma = None
+    endpoint.outstanding = 4
+    assert pool.choose_profile(latency_ms=1000, queue_depth=4) == "fast"
+    assert pool.choose_profile(latency_ms=1000, queue_depth=0) == "full"
+
+
+def test_ml_pool_probes_full_profile_while_fast(stub_servers):
+    """Test that fast requests leave latency alone and full ones are still probed."""
+    server = stub_servers()
+    pool = ml_pool.MLPool([server.url])
+    endpoint = pool.endpoints[server.url]
+    endpoint.latency_ewma = 1.5
+    pool.fast_probe_seconds = 0.2
+    assert pool.choose_profile(latency_ms=1000, queue_depth=0) == "fast"
+
+    pool.post({"profile": "fast"})
+    assert endpoint.latency_ewma == 1.5
+    assert pool.choose_profile(latency_ms=1000, queue_depth=0) == "fast"
+
+    time.sleep(0.25)
+    assert pool.choose_profile(latency_ms=1000, queue_depth=0) == "full"
+    assert pool.choose_profile(latency_ms=1000, queue_depth=0) == "fast"
+
+    pool.post({"profile": "full"})
+    assert endpoint.latency_ewma < 1.5
+
+
+def load_ml_compact_results():
+    """Import the ML client's copy of compact_results under a distinct name."""
+    path = os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        "machine-learning-client",
+        "src",
+        "compact_results.py",
+    )
+    with open(path, encoding="utf-8") as ml_copy, open(
+        compact_results.__file__, encoding="utf-8"
+    ) as web_copy:
+        assert ml_copy.read() == web_copy.read(), "compact_results copies differ"
+    spec = importlib.util.spec_from_file_location("ml_compact_results", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+SHARED_MARKER = (
+    "# Everything below is identical in both services' copies of this module."
+)
+
+
+@pytest.mark.parametrize("name", ["cache.py", "capture.py", "profiler.py"])
+def test_shared_module_copies_match_ml_client(name):
+    """Test that modules copied into both services only differ in their settings."""
+    copies = []
+    for service in ("web-app", "machine-learning-client"):
+        path = os.path.join(os.path.dirname(__file__), "..", service, "src", name)
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        assert SHARED_MARKER in text, f"{service}/src/{name} lacks the shared marker"
+        copies.append(text.split(SHARED_MARKER, 1)[1])
+    assert copies[0] == copies[1], f"{name} copies differ below the shared marker"
+
+
+def test_compact_results_wire_format_matches_ml_client():
+    """Test that both services' copies of the compact wire format agree."""
+    ml_compact = load_ml_compact_results()
+    for name in ("WIRE_VERSION", "EMOTIONS", "GENDERS", "REGION_KEYS"):
+        assert getattr(compact_results, name) == getattr(ml_compact, name), name
+
+    face = {
+        "region": {"x": 1, "y": 2, "w": 3, "h": 4},
+        "age": 40,
+        "gender": {"Woman": 20.0, "Man": 80.0},
+        "emotion": {"sad": 70.0, "neutral": 30.0},
+    }
+    wire = ml_compact.compact([face])
+    assert compact_results.compact([face]) == wire
+    assert compact_results.expand(wire) == ml_compact.expand(wire)